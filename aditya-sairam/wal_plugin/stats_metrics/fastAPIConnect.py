@@ -1,19 +1,130 @@
-from fastapi import FastAPI, HTTPException
-import redis
+from fastapi import FastAPI, HTTPException, Request, Response
+import redis.asyncio as redis
+import pyarrow as pa
+import pyarrow.compute as pc
+from typing import Optional
+import datetime
+import hashlib
 import json
+import os
+import time
 
 app = FastAPI()
 
-r = redis.Redis(host="host.docker.internal", port=6379, decode_responses=True)
+# One async connection pool per worker, shared by every request
+pool = redis.ConnectionPool(host=os.getenv("REDIS_HOST", "host.docker.internal"),
+                            port=int(os.getenv("REDIS_PORT", "6379")))
+r = redis.Redis(connection_pool=pool)
+
+CACHE_TTL_SECONDS = float(os.getenv("CACHE_TTL_SECONDS", "2"))  # How long a response is served without asking Redis
+CACHE_MAX_ENTRIES = 1024
+response_cache = {}  # request key -> (expires at, etag, body)
+
+ARROW_STREAM = "application/vnd.apache.arrow.stream"
+
+
+def bucket_score(value, default):
+    """Turn a bucket time (ISO 8601, naive means UTC, or epoch nanoseconds) into a sorted-set score."""
+    if value is None:
+        return default
+    if value.lstrip("-").isdigit():
+        return value
+    try:
+        parsed = datetime.datetime.fromisoformat(value.replace("Z", "+00:00"))
+    except ValueError:
+        raise HTTPException(status_code=400, detail=f"Invalid bucket time: {value}")
+    if parsed.tzinfo is None:
+        parsed = parsed.replace(tzinfo=datetime.timezone.utc)
+    epoch = datetime.datetime(1970, 1, 1, tzinfo=datetime.timezone.utc)
+    return str((parsed - epoch) // datetime.timedelta(microseconds=1) * 1000)
+
+
+async def fetch_rows(database, table, fields, start, end, limit, offset):
+    """Read one page of analytics rows (JSON layout), ordered by bucket then field, as JSON strings."""
+    if fields is None:
+        fields = sorted(field.decode() for field in await r.smembers(f"{database}:{table}:fields"))
+    if not fields:
+        return None
+
+    # A page of the merged result needs at most offset + limit members from each field
+    async with r.pipeline(transaction=False) as pipe:
+        for field in fields:
+            pipe.zrangebyscore(f"{database}:{table}:{field}", start, end, start=0, num=offset + limit, withscores=True)
+        results = await pipe.execute()
+
+    members = sorted((score, field, member) for field, rows in zip(fields, results) for member, score in rows)
+    return [member.split(b":", 1)[1].decode() for _, _, member in members[offset:offset + limit]]
+
+
+async def fetch_arrow_rows(database, table, fields, start, end, limit, offset):
+    """Read one page of analytics rows (Arrow layout, redis_format=arrow) as a pyarrow.Table."""
+    async with r.pipeline(transaction=False) as pipe:
+        pipe.hgetall(f"{database}:{table}:schemas")
+        # Every member holds at least one row per field, so without a field filter offset + limit members cover the page
+        page = (0, offset + limit) if fields is None else (None, None)
+        pipe.zrangebyscore(f"{database}:{table}:buckets", start, end, *page)
+        stored_schemas, members = await pipe.execute()
+
+    schemas = {schema_id: pa.ipc.read_schema(pa.py_buffer(data)) for schema_id, data in stored_schemas.items()}
+    tables = []
+    for member in members:
+        _, schema_id, message = member.split(b":", 2)
+        if schema_id in schemas:
+            batch = pa.ipc.read_record_batch(pa.py_buffer(message), schemas[schema_id])
+            tables.append(pa.Table.from_batches([batch]))
+    if not tables:
+        return pa.table({"field_name": pa.array([], pa.string())})
+    rows = pa.concat_tables(tables, promote_options="default")
+    if fields is not None:
+        rows = rows.filter(pc.is_in(rows["field_name"], value_set=pa.array(fields)))
+    return rows.slice(offset, limit)
+
+
+def arrow_stream(rows):
+    """Serialize a pyarrow.Table in the Arrow IPC streaming format."""
+    sink = pa.BufferOutputStream()
+    with pa.ipc.new_stream(sink, rows.schema) as writer:
+        writer.write_table(rows)
+    return sink.getvalue().to_pybytes()
+
 
 @app.get("/analytics/{table}")
-async def get_analytics(database: str, table: str):
-    key = f"{table}"
-    
-    data = r.get(key)
-    print(key)
-    if data:
-        return json.loads(data)  
-    else:
-        raise HTTPException(status_code=404, detail=f"No data found for {key}")
+async def get_analytics(request: Request, database: str, table: str,
+                        start: Optional[str] = None, end: Optional[str] = None,
+                        fields: Optional[str] = None, limit: int = 1000, offset: int = 0):
+    if limit < 1 or offset < 0:
+        raise HTTPException(status_code=400, detail="limit must be positive and offset non-negative")
+    field_list = [field for field in fields.split(",") if field] if fields else None
+    media_type = ARROW_STREAM if ARROW_STREAM in request.headers.get("accept", "") else "application/json"
+    cache_key = (database, table, start, end, tuple(field_list) if field_list else None, limit, offset, media_type)
+
+    now = time.monotonic()
+    cached = response_cache.get(cache_key)
+    if cached is None or cached[0] <= now:
+        query = (database, table, field_list, bucket_score(start, "-inf"), bucket_score(end, "+inf"), limit, offset)
+        if await r.exists(f"{database}:{table}:buckets"):
+            rows = await fetch_arrow_rows(*query)
+            if media_type == ARROW_STREAM:
+                body = arrow_stream(rows)
+            else:
+                body = json.dumps(rows.to_pylist()).encode()
+        else:
+            rows = await fetch_rows(*query)
+            if rows is None:
+                raise HTTPException(status_code=404, detail=f"No data found for {database}:{table}")
+            if media_type == ARROW_STREAM:
+                body = arrow_stream(pa.Table.from_pylist([json.loads(row) for row in rows]))
+            else:
+                # Members already hold the row JSON, so the response is assembled without decoding it
+                body = ("[" + ",".join(rows) + "]").encode()
+        cached = (now + CACHE_TTL_SECONDS, f'"{hashlib.sha1(body).hexdigest()}"', body)
+        if len(response_cache) >= CACHE_MAX_ENTRIES:
+            for key in [key for key, entry in response_cache.items() if entry[0] <= now] or list(response_cache):
+                del response_cache[key]
+        response_cache[cache_key] = cached
 
+    _, etag, body = cached
+    headers = {"ETag": etag, "Cache-Control": f"max-age={int(CACHE_TTL_SECONDS)}", "Vary": "Accept"}
+    if request.headers.get("if-none-match") == etag:
+        return Response(status_code=304, headers=headers)
+    return Response(content=body, media_type=media_type, headers=headers)
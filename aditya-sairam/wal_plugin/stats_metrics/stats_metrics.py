@@ -1,44 +1,547 @@
 import datetime
-from collections import defaultdict
+import hashlib
+import heapq
+import json
+import math
+import time
+import warnings
+from collections import defaultdict, deque
+import numpy as np
 import pandas as pd
 from pydantic import BaseModel
 from typing import List
 import redis 
 
+try:
+    import pyarrow as pa  # Only needed for redis_format=arrow
+except ImportError:
+    pa = None
+
 analytics_data = []  # Global storage for analytics
 
 import pandas as pd
 
 
 
-redis_client = redis.Redis(host="host.docker.internal", port=6379, decode_responses=True)
+# One connection pool per plugin process, shared by every flush
+redis_pool = redis.ConnectionPool(host="host.docker.internal", port=6379)
+redis_client = redis.Redis(connection_pool=redis_pool)
 analytics_data = [] 
 
-
-def save_to_redis(df, table_name,database_name):
-    redis_key = f"{database_name}:{table_name}"  # Key format
-    redis_client.set(redis_key, df.to_json(orient="records"))  # Store as JSON
-
-def calculate_median(values):
-    sorted_values = sorted(values)
-    n = len(sorted_values)
-    if n % 2 == 1:
-        return sorted_values[n // 2]
+DIGEST_COMPRESSION = 200  # t-digest accuracy/size trade-off: about half this many centroids per field and bucket
+STATE_CACHE_PREFIX = "stats_state"  # Cache key prefix for the running aggregate state of an analytics table
+ROLLING_CACHE_PREFIX = "stats_rolling"  # Cache key prefix for the rolling windows of an analytics table
+ROLLING_PANES = 10  # Default panes per rolling window: expiry granularity is window / ROLLING_PANES
+MODE_CAPACITY = 64  # Counters kept by the mode sketch per field and bucket
+STATE_MAX_BUCKETS = 1000  # Default cap on time buckets kept in the cached state per table (state_max_buckets)
+STATISTICS = ("min", "max", "mean", "median", "mode", "95Percentile", "count")  # Everything a table can ask for
+
+# Buckets are aligned to datetime.min (as with timedelta arithmetic); this is its distance from the Unix epoch
+EPOCH_OFFSET_NS = (datetime.datetime(1970, 1, 1) - datetime.datetime.min) // datetime.timedelta(microseconds=1) * 1000
+
+
+def save_to_redis(pipe, entries, table_name, database_name, ttl_ns=None, redis_format="json", compression=None,
+                  legacy_key=True, stored=None):
+    """
+    Queue the Redis updates publishing one table's analytics rows of this flush on `pipe`.
+
+    process_writes() queues every table on one pipeline and executes it once per flush.
+
+    JSON format: each field gets a sorted set `database:table:field` scored by bucket start (ns,
+    0 for the all-time aggregate) whose members are `"<score>:<row json>"`.
+    Arrow format: see queue_arrow_buckets(); `stored` is this table's read_arrow_buckets() result.
+    A bucket's previous member is replaced, untouched buckets are left alone. Field names are
+    indexed in `database:table:fields`. With `ttl_ns`, buckets older than that before the newest
+    one are trimmed and idle keys expire.
+    With `legacy_key`, this flush's rows are also stored as one JSON list under `database:table`,
+    the key read by fastAPIConnect before the sorted-set layout.
+    """
+    fields_key = f"{database_name}:{table_name}:fields"
+    newest = {}
+    if redis_format == "arrow":
+        newest = queue_arrow_buckets(pipe, entries, table_name, database_name, stored, compression)
     else:
-        return (sorted_values[n // 2 - 1] + sorted_values[n // 2]) / 2
-
-def calculate_mode(values):
-    freq = {}
-    for v in values:
-        freq[v] = freq.get(v, 0) + 1
-    max_count = max(freq.values())
-    modes = [k for k, v in freq.items() if v == max_count]
-    return modes[0] if len(modes) == 1 else None  # Return first mode or None if multimodal
+        for bucket_start, row in entries:
+            field_key = f"{database_name}:{table_name}:{row['field_name']}"
+            score = bucket_start or 0
+            pipe.zremrangebyscore(field_key, score, score)
+            pipe.zadd(field_key, {f"{score}:{json.dumps(row)}": score})
+            newest[field_key] = max(newest.get(field_key, score), score)
+    pipe.sadd(fields_key, *{row["field_name"] for _, row in entries})
+    if legacy_key:
+        pipe.set(f"{database_name}:{table_name}", json.dumps([row for _, row in entries]))
+    if ttl_ns:
+        ttl_seconds = max(1, math.ceil(ttl_ns / 1e9))
+        for key, score in newest.items():
+            if score:
+                pipe.zremrangebyscore(key, "-inf", f"({score - ttl_ns}")
+            pipe.expire(key, ttl_seconds)
+        pipe.expire(fields_key, ttl_seconds)
+        if redis_format == "arrow":
+            pipe.expire(f"{database_name}:{table_name}:schemas", ttl_seconds)
+        if legacy_key:
+            pipe.expire(f"{database_name}:{table_name}", ttl_seconds)
+
+def read_arrow_buckets(tables, database_name):
+    """
+    Fetch what an Arrow-format flush merges into, for every table, in one pipelined round trip.
+
+    `tables` maps analytics table -> entries. Returns analytics table -> (stored schemas hash,
+    {bucket score: current members of that bucket}).
+    """
+    reader = redis_client.pipeline(transaction=False)
+    scores = {}
+    for table_name, entries in tables.items():
+        scores[table_name] = list(dict.fromkeys(bucket_start or 0 for bucket_start, _ in entries))
+        reader.hgetall(f"{database_name}:{table_name}:schemas")
+        for score in scores[table_name]:
+            reader.zrangebyscore(f"{database_name}:{table_name}:buckets", score, score)
+    results = iter(reader.execute())
+    return {table_name: (next(results), {score: next(results) for score in table_scores})
+            for table_name, table_scores in scores.items()}
+
+def arrow_schema(rows):
+    """Arrow schema for analytics rows: string columns for tags, float64 for statistics, in first-seen order."""
+    columns = {}
+    for row in rows:
+        for name, value in row.items():
+            if name not in columns:
+                columns[name] = pa.string() if isinstance(value, str) else pa.float64()
+    return pa.schema(list(columns.items()))
+
+def queue_arrow_buckets(pipe, entries, table_name, database_name, stored, compression=None):
+    """
+    Queue the Arrow-format Redis updates for this flush on `pipe`; return {key: newest score}.
+
+    All fields of a bucket share one member of the sorted set `database:table:buckets`, so the
+    per-message Arrow overhead is paid once per bucket rather than once per row: the member is
+    `"<score>:<schema id>:"` followed by an Arrow IPC record batch message (no schema, optionally
+    lz4/zstd compressed), sorted by field. Schemas are stored once in the hash `database:table:schemas`
+    keyed by schema id. Fields a flush did not touch are carried over from the bucket's current member,
+    as fetched into `stored` by read_arrow_buckets().
+    """
+    buckets_key = f"{database_name}:{table_name}:buckets"
+    schemas_key = f"{database_name}:{table_name}:schemas"
+    buckets = defaultdict(dict)
+    for bucket_start, row in entries:
+        buckets[bucket_start or 0][row["field_name"]] = row
+
+    stored_schemas, stored_members = stored
+    schemas = {schema_id: pa.ipc.read_schema(pa.py_buffer(data)) for schema_id, data in stored_schemas.items()}
+    for score in buckets:
+        for member in stored_members.get(score, ()):
+            _, schema_id, message = member.split(b":", 2)
+            if schema_id not in schemas:
+                continue
+            batch = pa.ipc.read_record_batch(pa.py_buffer(message), schemas[schema_id])
+            for row in batch.to_pylist():
+                buckets[score].setdefault(row["field_name"], {name: value for name, value in row.items() if value is not None})
+
+    by_schema = defaultdict(list)
+    for score, rows in buckets.items():
+        rows = [rows[field_name] for field_name in sorted(rows)]
+        schema = arrow_schema(rows)
+        by_schema[schema].append((score, pa.RecordBatch.from_pylist(rows, schema=schema)))
+
+    for schema, batches in by_schema.items():
+        schema_bytes = schema.serialize().to_pybytes()
+        schema_id = hashlib.sha1(schema_bytes).hexdigest()[:12].encode()
+        pipe.hset(schemas_key, schema_id, schema_bytes)
+        # Write one compressed IPC stream and take the batch messages back out of it
+        sink = pa.BufferOutputStream()
+        with pa.ipc.new_stream(sink, schema, options=pa.ipc.IpcWriteOptions(compression=compression)) as writer:
+            for _, batch in batches:
+                writer.write_batch(batch)
+        messages = pa.ipc.MessageReader.open_stream(sink.getvalue())
+        messages.read_next_message()  # schema
+        for score, _ in batches:
+            member = f"{score}:".encode() + schema_id + b":" + messages.read_next_message().serialize().to_pybytes()
+            pipe.zremrangebyscore(buckets_key, score, score)
+            pipe.zadd(buckets_key, {member: score})
+    return {buckets_key: max(buckets)}
+
+class TDigest:
+    """
+    Mergeable t-digest (Dunning & Ertl, merging variant) for streaming quantiles.
+
+    Values are summarized as centroids (mean, weight), kept small near the
+    tails and larger in the middle, so median and p95 are accurate while the
+    state stays bounded (about compression / 2 centroids) no matter how many
+    values were added. Digests built on different flushes merge by simply
+    recompressing their centroids together. Count, min and max are exact.
+    """
+
+    def __init__(self, compression=DIGEST_COMPRESSION):
+        self.compression = compression
+        self.means = []
+        self.weights = []
+        self.count = 0
+        self.min = math.inf
+        self.max = -math.inf
+
+    def merge(self, other):
+        """Fold another digest's centroids into this one."""
+        self._compress(list(zip(other.means, other.weights)))
+        self.min = min(self.min, other.min)
+        self.max = max(self.max, other.max)
+
+    def _compress(self, extra=()):
+        if not extra:
+            return
+        centroids = sorted(list(zip(self.means, self.weights)) + list(extra))
+        total = sum(weight for _, weight in centroids)
+        self.count = total
+
+        # Merge neighbours while the merged centroid spans at most one unit of the k1 scale function
+        scale = self.compression / (2 * math.pi)
+        means, weights = [], []
+        cum = 0.0
+        k_lower = scale * math.asin(-1.0)
+        mean, weight = centroids[0]
+        for next_mean, next_weight in centroids[1:]:
+            q = min(1.0, (cum + weight + next_weight) / total)
+            if scale * math.asin(2 * q - 1) - k_lower <= 1:
+                weight += next_weight
+                mean += (next_mean - mean) * next_weight / weight
+                continue
+            means.append(mean)
+            weights.append(weight)
+            cum += weight
+            k_lower = scale * math.asin(2 * min(1.0, cum / total) - 1)
+            mean, weight = next_mean, next_weight
+        means.append(mean)
+        weights.append(weight)
+        self.means, self.weights = means, weights
+
+    def quantile(self, q):
+        """Estimate the q-quantile (0 <= q <= 1) by interpolating between centroid centers."""
+        if not self.count:
+            return None
+        if len(self.means) == 1:
+            return self.means[0]
+        target = q * self.count
+        # Centroid i covers the weight around its center at cum + weight / 2
+        cum = 0.0
+        prev_center, prev_mean = 0.0, self.min
+        for mean, weight in zip(self.means, self.weights):
+            center = cum + weight / 2
+            if target < center:
+                if center == prev_center:
+                    return mean
+                return prev_mean + (mean - prev_mean) * (target - prev_center) / (center - prev_center)
+            prev_center, prev_mean = center, mean
+            cum += weight
+        if self.count == prev_center:
+            return self.max
+        return prev_mean + (self.max - prev_mean) * (target - prev_center) / (self.count - prev_center)
+
+    def to_state(self):
+        """Compact, cache-friendly representation (see from_state())."""
+        return [self.compression, self.min, self.max, self.means, self.weights]
+
+    @classmethod
+    def from_sorted(cls, values, compression=DIGEST_COMPRESSION):
+        """
+        Build a digest from an already sorted NumPy array in one vectorized pass.
+
+        Each value is assigned to a centroid by the integer part of its k1
+        scale position, so every centroid spans at most one unit of k, and
+        centroid means are computed with a single grouped sum.
+        """
+        digest = cls(compression)
+        n = len(values)
+        if not n:
+            return digest
+        scale = compression / (2 * math.pi)
+        q = (np.arange(n) + 0.5) / n
+        groups = np.floor(scale * (np.arcsin(2 * q - 1) + math.pi / 2)).astype(np.int64)
+        starts = np.flatnonzero(np.r_[True, groups[1:] != groups[:-1]])
+        weights = np.diff(np.r_[starts, n])
+        digest.means = (np.add.reduceat(values, starts) / weights).tolist()
+        digest.weights = weights.tolist()
+        digest.count = n
+        digest.min = float(values[0])
+        digest.max = float(values[-1])
+        return digest
+
+    @classmethod
+    def from_quantiles(cls, count, min_value, median, percentile_95, max_value, compression=DIGEST_COMPRESSION):
+        """
+        Seed a digest from stored summary statistics (cold start).
+
+        Four centroids are weighted so that their centers fall exactly on the
+        median and the 95th percentile, so the rebuilt digest reproduces both
+        until new values refine it.
+        """
+        digest = cls(compression)
+        if not count:
+            return digest
+        digest.means = [min_value, median, percentile_95, max_value]
+        digest.weights = [0.075 * count, 0.85 * count, 0.05 * count, 0.025 * count]
+        digest.count = count
+        digest.min = min_value
+        digest.max = max_value
+        return digest
+
+    @classmethod
+    def from_state(cls, state):
+        digest = cls(state[0])
+        digest.min, digest.max, digest.means, digest.weights = state[1], state[2], list(state[3]), list(state[4])
+        digest.count = sum(digest.weights)
+        return digest
+
+
+class SpaceSaving:
+    """
+    Space-Saving heavy-hitter sketch (Metwally et al.) of quantized values, for a streaming mode.
+
+    At most `capacity` (value, count) counters are kept, so memory stays fixed however many
+    distinct values a field has. Counts may overestimate by at most the smallest counter, and
+    any value seen more often than that is guaranteed to be tracked. Sketches merge by adding
+    counters, charging a value missing from a full sketch with that sketch's smallest counter
+    (Agarwal et al.), and keeping the largest `capacity`.
+    """
+
+    def __init__(self, capacity=MODE_CAPACITY, counts=None):
+        self.capacity = capacity
+        self.counts = counts or {}
+
+    @classmethod
+    def from_values(cls, values, precision=None, capacity=MODE_CAPACITY):
+        """Sketch a NumPy array, rounded to `precision` decimals first (None keeps exact values)."""
+        if precision is not None:
+            values = np.round(values, precision)
+        distinct, counts = np.unique(values, return_counts=True)
+        if len(distinct) > capacity:
+            top = np.argpartition(counts, -capacity)[-capacity:]
+            distinct, counts = distinct[top], counts[top]
+        return cls(capacity, dict(zip(distinct.tolist(), counts.tolist())))
+
+    def _floor(self):
+        return min(self.counts.values()) if len(self.counts) >= self.capacity else 0
+
+    def merge(self, other):
+        floor, other_floor = self._floor(), other._floor()
+        merged = {value: count + other.counts.get(value, other_floor) for value, count in self.counts.items()}
+        for value, count in other.counts.items():
+            if value not in merged:
+                merged[value] = floor + count
+        self.counts = dict(heapq.nlargest(self.capacity, merged.items(), key=lambda item: item[1]))
+
+    def mode(self):
+        """
+        The most frequent (quantized) value, the smallest on a tie.
+
+        None if empty, or if no value repeats beyond the sketch's error floor (e.g. unquantized
+        continuous data), where the top counter would only name an arbitrary sample.
+        """
+        if not self.counts:
+            return None
+        value, count = min(self.counts.items(), key=lambda item: (-item[1], item[0]))
+        if count <= max(1, self._floor()):
+            return None
+        return value
+
+    def to_state(self):
+        return [self.capacity, list(self.counts), list(self.counts.values())]
+
+    @classmethod
+    def from_state(cls, state):
+        capacity, values, counts = state
+        return cls(capacity, dict(zip(values, counts)))
+
+class RollingWindow:
+    """
+    Sliding-window statistics of one field, updated in O(new data) per flush.
+
+    Values are grouped into fixed panes that each keep count, sum, min, max, a t-digest and
+    (optionally) a mode sketch. As newer data arrives, panes older than the window expire from
+    the front, the running count and sum are adjusted on insert and expiry, and the window
+    min/max are read off monotonic deques of pane minima/maxima, so nothing is rescanned.
+    Median, 95th percentile and mode merge the sketches of the live panes. The window ends
+    at the newest pane, i.e. it follows data time rather than wall-clock time.
+    """
+
+    def __init__(self, window_ns, pane_ns):
+        self.window_ns = window_ns
+        self.pane_ns = pane_ns
+        self.panes = deque()  # [start, count, sum, min, max, digest state, sketch state or None], oldest first
+        self.mins = deque()  # (pane start, pane min), values increasing
+        self.maxs = deque()  # (pane start, pane max), values decreasing
+        self.count = 0
+        self.sum = 0.0
+
+    def add(self, pane_start, batch_stats, mode_precision=None, mode_capacity=None):
+        """Fold one pane's worth of a flush (an aggregate_buckets() entry) into the window."""
+        if self.panes and pane_start < self.panes[-1][0] + self.pane_ns - self.window_ns:
+            return  # Already expired
+        digest = TDigest.from_sorted(batch_stats["values"])
+        sketch = SpaceSaving.from_values(batch_stats["values"], mode_precision, mode_capacity) if mode_capacity else None
+        self.count += batch_stats["count"]
+        self.sum += batch_stats["sum"]
+
+        position = len(self.panes)
+        while position and self.panes[position - 1][0] > pane_start:
+            position -= 1
+        if position and self.panes[position - 1][0] == pane_start:
+            pane = self.panes[position - 1]
+            pane[1] += batch_stats["count"]
+            pane[2] += batch_stats["sum"]
+            pane[3] = min(pane[3], batch_stats["min"])
+            pane[4] = max(pane[4], batch_stats["max"])
+            merged = TDigest.from_state(pane[5])
+            merged.merge(digest)
+            pane[5] = merged.to_state()
+            if sketch is not None and pane[6] is not None:
+                merged_sketch = SpaceSaving.from_state(pane[6])
+                merged_sketch.capacity = mode_capacity
+                merged_sketch.merge(sketch)
+                sketch = merged_sketch
+            pane[6] = sketch.to_state() if sketch is not None else None
+        else:
+            pane = [pane_start, batch_stats["count"], batch_stats["sum"], batch_stats["min"], batch_stats["max"],
+                    digest.to_state(), sketch.to_state() if sketch is not None else None]
+            self.panes.insert(position, pane)
+
+        if pane is self.panes[-1]:
+            self._push_extrema(pane)
+        else:
+            # Late data for an older pane: the deques are only valid when fed in time order
+            self.mins.clear()
+            self.maxs.clear()
+            for pane in self.panes:
+                self._push_extrema(pane)
+
+    def _push_extrema(self, pane):
+        while self.mins and self.mins[-1][1] >= pane[3]:
+            self.mins.pop()
+        self.mins.append((pane[0], pane[3]))
+        while self.maxs and self.maxs[-1][1] <= pane[4]:
+            self.maxs.pop()
+        self.maxs.append((pane[0], pane[4]))
+
+    def expire(self):
+        """Drop panes that fell out of the window; return the window end (ns)."""
+        end = self.panes[-1][0] + self.pane_ns
+        cutoff = end - self.window_ns
+        while self.panes[0][0] < cutoff:
+            pane = self.panes.popleft()
+            self.count -= pane[1]
+            self.sum -= pane[2]
+        for extrema in (self.mins, self.maxs):
+            while extrema[0][0] < cutoff:
+                extrema.popleft()
+        return end
+
+    def statistics(self, stats):
+        digest = sketch = None
+        if "median" in stats or "95Percentile" in stats:
+            digest = TDigest.from_state(self.panes[0][5])
+            for pane in list(self.panes)[1:]:
+                digest.merge(TDigest.from_state(pane[5]))
+        if "mode" in stats:
+            sketches = [SpaceSaving.from_state(pane[6]) for pane in self.panes if pane[6] is not None]
+            sketch = sketches[0] if sketches else SpaceSaving()  # No pane kept a mode sketch
+            for other in sketches[1:]:
+                sketch.merge(other)
+        return statistic_values(stats, self.count, self.sum, self.mins[0][1], self.maxs[0][1], digest, sketch)
+
+def load_state(influxdb3_local, analytics_table, mode_capacity=MODE_CAPACITY):
+    """
+    Return the running aggregate state of an analytics table from the plugin cache.
+
+    The state maps (bucket start ns or None, field name) to a compact
+    [count, sum, min, max, digest state, mode sketch state or None] list. Only on a cold start (nothing
+    cached, e.g. after a restart) is it rebuilt from the latest row per field
+    and bucket in the analytics table.
+    """
+    state = influxdb3_local.cache.get(f"{STATE_CACHE_PREFIX}:{analytics_table}", default=None)
+    if state is None:
+        state = rebuild_state(influxdb3_local, analytics_table, mode_capacity)
+    return state
+
+def rebuild_state(influxdb3_local, analytics_table, mode_capacity=MODE_CAPACITY):
+    """
+    Rebuild aggregate state from the analytics table (cold start only).
+
+    The stored mode is seeded with count / mode_capacity, the least number of times it can have
+    occurred while its sketch was exact, so a few new rows do not displace it.
+    """
+    try:
+        rows = influxdb3_local.query(f'SELECT * FROM "{analytics_table}"')
+    except Exception:
+        influxdb3_local.info(f"No existing statistics in {analytics_table}; starting fresh")
+        return {}
+
+    latest = {}
+    for row in rows or []:
+        label = row.get("time_bucket")
+        key = (timestamp_ns(label) if label else None, row["field_name"])
+        if key not in latest or row.get("time", 0) > latest[key].get("time", 0):
+            latest[key] = row
+
+    state = {}
+    for key, row in latest.items():
+        count = int(row.get("count") or 0)
+        if not count or any(row.get(stat) is None for stat in ("min", "max", "mean")):
+            continue  # Tables configured without these statistics start afresh
+        median = row.get("median")
+        percentile_95 = row.get("95Percentile", row.get("95th_percentile"))
+        digest = TDigest.from_quantiles(count, row["min"], row["mean"] if median is None else median,
+                                        row["max"] if percentile_95 is None else percentile_95, row["max"])
+        mode = row.get("mode")
+        sketch = SpaceSaving(mode_capacity)
+        if mode is not None:
+            sketch.counts[mode] = math.ceil(count / mode_capacity)
+        state[key] = [count, row["mean"] * count, row["min"], row["max"], digest.to_state(), sketch.to_state()]
+    influxdb3_local.info(f"Rebuilt statistics state for {len(state)} field buckets from {analytics_table}")
+    return state
+
+def merge_into_state(state, key, batch_stats, mode_precision=None, mode_capacity=None):
+    """
+    Fold one flush's statistics for a field and bucket into the running state.
+
+    The mode sketch is only maintained when `mode_capacity` is given.
+
+    Returns:
+        tuple: (state entry, merged TDigest, merged SpaceSaving or None)
+    """
+    entry = state.get(key)
+    batch_digest = TDigest.from_sorted(batch_stats["values"])
+    batch_sketch = SpaceSaving.from_values(batch_stats["values"], mode_precision, mode_capacity) if mode_capacity else None
+    if entry is None:
+        entry = [batch_stats["count"], batch_stats["sum"], batch_stats["min"], batch_stats["max"], None, None]
+        digest, sketch = batch_digest, batch_sketch
+    else:
+        entry[0] += batch_stats["count"]
+        entry[1] += batch_stats["sum"]
+        entry[2] = min(entry[2], batch_stats["min"])
+        entry[3] = max(entry[3], batch_stats["max"])
+        digest = TDigest.from_state(entry[4])
+        digest.merge(batch_digest)
+        if len(entry) < 6:
+            entry.append(None)  # State cached before the mode sketch existed
+        sketch = batch_sketch
+        if batch_sketch is not None and entry[5] is not None:
+            sketch = SpaceSaving.from_state(entry[5])
+            sketch.capacity = mode_capacity
+            sketch.merge(batch_sketch)
+    entry[4] = digest.to_state()
+    entry[5] = sketch.to_state() if sketch is not None else entry[5]
+    state[key] = entry
+    return entry, digest, sketch
+
+def prune_state(state, retention_ns=None, max_buckets=STATE_MAX_BUCKETS):
+    """Keep at most the newest `max_buckets` buckets, and none that started more than `retention_ns` before the newest."""
+    starts = sorted({bucket_start for bucket_start, _ in state if bucket_start is not None})
+    if not starts:
+        return
+    cutoff = starts[-max_buckets] if len(starts) > max_buckets else starts[0]
+    if retention_ns:
+        cutoff = max(cutoff, starts[-1] - retention_ns)
+    for key in [key for key in state if key[0] is not None and key[0] < cutoff]:
+        del state[key]
 
-def calculate_percentile(values, percentile):
-    sorted_values = sorted(values)
-    index = int(len(sorted_values) * (percentile / 100))
-    return sorted_values[min(index, len(sorted_values) - 1)]  # Ensure valid index
 
 def parse_time_sampling(time_sampling):
     """Parse the time_sampling string (e.g., '10d') into a timedelta."""
@@ -55,238 +558,341 @@ def parse_time_sampling(time_sampling):
     else:
         raise ValueError(f"Unsupported time unit: {unit}")
 
-def parse_timestamp(time_value):
-    """Parse a timestamp (ISO string, Unix timestamp in seconds/milliseconds/nanoseconds) into a datetime object."""
+def duration_ns(duration):
+    """parse_time_sampling() in nanoseconds."""
+    return parse_time_sampling(duration) // datetime.timedelta(microseconds=1) * 1000
+
+def parse_table_configs(influxdb3_local, args):
+    """
+    Read the per-table aggregation settings from the trigger arguments.
+
+    Tables come from `tables` (separated by ';') and/or the single `table_name`. Each table
+    can override the trigger-wide `time_sampling` and `stats` with `<table>_time_sampling`
+    and `<table>_stats` (likewise `rolling_window`, `rolling_pane`, `mode_precision` and
+    `mode_capacity`), and limit the fields it aggregates with `<table>_fields`; `stats` and
+    `fields` are ';'-separated lists. A rolling window replaces time buckets for its table.
+
+    Returns:
+        dict: table name -> {"analytics_table", "fields" (set or None), "bucket_ns" (or None), "stats",
+            "window" (or None), "window_ns", "pane_ns", "mode_precision" (or None), "mode_capacity"}
+    """
+    args = args or {}
+    names = [name.strip() for name in args.get("tables", "").split(";") if name.strip()]
+    if args.get("table_name") and args["table_name"] not in names:
+        names.append(args["table_name"])
+
+    configs = {}
+    for name in names:
+        time_sampling = args.get(f"{name}_time_sampling", args.get("time_sampling"))
+        time_bucket = time_sampling.split(" ")[-1] if time_sampling else None
+        fields = args.get(f"{name}_fields")
+        stats = args.get(f"{name}_stats", args.get("stats"))
+        stats = [stat.strip() for stat in stats.split(";") if stat.strip()] if stats else list(STATISTICS)
+        unknown = [stat for stat in stats if stat not in STATISTICS]
+        if unknown:
+            influxdb3_local.warn(f"Ignoring unknown statistics for {name}: {unknown}")
+        mode_precision = args.get(f"{name}_mode_precision", args.get("mode_precision"))
+        window = args.get(f"{name}_rolling_window", args.get("rolling_window"))
+        pane = args.get(f"{name}_rolling_pane", args.get("rolling_pane"))
+        window_ns = duration_ns(window) if window else None
+        pane_ns = (duration_ns(pane) if pane else max(1, window_ns // ROLLING_PANES)) if window else None
+        if window and pane_ns > window_ns:
+            influxdb3_local.error(f"rolling_pane {pane} is longer than rolling_window {window} for {name}; skipping table")
+            continue
+        configs[name] = {
+            "analytics_table": f"analytics_{name}",
+            "fields": {field.strip() for field in fields.split(";") if field.strip()} if fields else None,
+            "bucket_ns": duration_ns(time_bucket) if time_bucket else None,
+            "stats": [stat for stat in STATISTICS if stat in stats],
+            "window": window,
+            "window_ns": window_ns,
+            "pane_ns": pane_ns,
+            "mode_precision": int(mode_precision) if mode_precision else None,
+            "mode_capacity": int(args.get(f"{name}_mode_capacity", args.get("mode_capacity", MODE_CAPACITY))),
+        }
+    return configs
+
+def timestamp_ns(time_value):
+    """Convert a timestamp (ISO string, Unix timestamp in seconds/milliseconds/microseconds/nanoseconds) to integer nanoseconds."""
     if isinstance(time_value, str):
-        return datetime.datetime.fromisoformat(time_value)
+        parsed = datetime.datetime.fromisoformat(time_value)
+        if parsed.tzinfo is not None:
+            parsed = parsed.astimezone(datetime.timezone.utc).replace(tzinfo=None)
+        return (parsed - datetime.datetime(1970, 1, 1)) // datetime.timedelta(microseconds=1) * 1000
     elif isinstance(time_value, (int, float)):
-        if time_value > 1e18:  
-            time_value = time_value / 1e9 
-        elif time_value > 1e12: 
-            time_value = time_value / 1000  
-        return datetime.datetime.fromtimestamp(time_value)
+        if time_value > 1e18:
+            return int(time_value)
+        elif time_value > 1e15:
+            return int(time_value * 1000)
+        elif time_value > 1e12:
+            return int(time_value * 1_000_000)
+        return int(time_value * 1_000_000_000)
     else:
         raise TypeError(f"Unsupported timestamp type: {type(time_value)}")
 
+def batch_timestamps_ns(time_values):
+    """
+    Convert a whole batch of timestamps to an int64 nanosecond array.
+
+    The unit of numeric timestamps (s/ms/us/ns) is detected once, from the
+    first value, and applied to the batch with a single array multiply; ISO
+    strings are parsed by NumPy in one call. Only values NumPy cannot parse
+    cleanly (e.g. strings with UTC offsets) fall back to timestamp_ns() per row.
+    """
+    if not time_values:
+        return np.empty(0, dtype=np.int64)
+    first = time_values[0]
+    if isinstance(first, str):
+        try:
+            with warnings.catch_warnings():
+                warnings.simplefilter("error")  # NumPy only warns about timezone offsets
+                return np.array(time_values, dtype="datetime64[ns]").astype(np.int64)
+        except (ValueError, UserWarning, DeprecationWarning):
+            return np.fromiter((timestamp_ns(value) for value in time_values), dtype=np.int64, count=len(time_values))
+    if not isinstance(first, (int, float)):
+        raise TypeError(f"Unsupported timestamp type: {type(first)}")
+    values = np.array(time_values)
+    if first > 1e18:
+        return values.astype(np.int64)
+    scale = 1000 if first > 1e15 else 1_000_000 if first > 1e12 else 1_000_000_000
+    if values.dtype.kind == "f":
+        return np.round(values * scale).astype(np.int64)
+    return values.astype(np.int64) * scale
+
+def bucket_label(bucket_start_ns):
+    """ISO label (naive UTC, e.g. '2020-05-06T00:00:00') of a bucket start."""
+    return (datetime.datetime(1970, 1, 1) + datetime.timedelta(microseconds=bucket_start_ns // 1000)).isoformat()
+
+def _is_number(text):
+    try:
+        float(text)
+        return True
+    except ValueError:
+        return False
+
+def batch_to_columns(rows, fields=None):
+    """
+    Convert a table batch to columnar NumPy arrays once (only `fields`, if given).
+
+    Returns:
+        tuple: (int64 nanosecond timestamps, {field name: float64 array}), with NaN
+            wherever a row has no value or a value that is not numeric. Fields
+            without any numeric value (e.g. tags) are left out.
+    """
+    records = [row["fields"] if "fields" in row else row for row in rows]
+    times = batch_timestamps_ns([row["time"] for row in rows])
+    columns = {}
+    for name in set().union(*records):
+        if name == "time" or (fields is not None and name not in fields):
+            continue
+        raw = [record.get(name) for record in records]
+        first = next((value for value in raw if value is not None), None)
+        if isinstance(first, str) and not _is_number(first):
+            continue  # Tag or string field (a column holds a single type)
+        try:
+            values = np.array(raw, dtype=np.float64)  # Fast path: numbers, bools and None
+        except (TypeError, ValueError):
+            values = pd.to_numeric(pd.Series(raw, dtype=object), errors="coerce").to_numpy(dtype=np.float64, na_value=np.nan)
+        if not np.isnan(values).all():
+            columns[name] = values
+    return times, columns
+
+def aggregate_buckets(times_ns, columns, bucket_ns):
+    """
+    Grouped min/max/sum/count per time bucket and field over a whole batch.
+
+    Rows are assigned to buckets with integer nanosecond arithmetic, then
+    sorted once by (bucket, value) per field so every reduction is a single
+    np.*.reduceat call and each bucket's values come out as a sorted slice
+    (for the quantile sketch and the mode) without per-value Python work.
+
+    Args:
+        times_ns (np.ndarray): int64 nanosecond timestamps.
+        columns (dict): Field name -> float64 values (NaN = missing).
+        bucket_ns (int): Bucket width in nanoseconds, or None for a single all-time bucket.
+
+    Returns:
+        dict: (bucket start ns or None, field name) -> {"min", "max", "sum", "count", "values"}
+            where "values" is the bucket's sorted, NaN-free values.
+    """
+    if bucket_ns:
+        offset = EPOCH_OFFSET_NS % bucket_ns
+        bucket_starts = times_ns - (times_ns + offset) % bucket_ns
+    else:
+        bucket_starts = np.zeros_like(times_ns)
+    results = {}
+    for field_name, values in columns.items():
+        present = ~np.isnan(values)
+        field_buckets = bucket_starts[present]
+        field_values = values[present]
+        if not len(field_values):
+            continue
+        order = np.lexsort((field_values, field_buckets))
+        field_buckets = field_buckets[order]
+        field_values = field_values[order]
+        starts = np.flatnonzero(np.r_[True, field_buckets[1:] != field_buckets[:-1]])
+        ends = np.r_[starts[1:], len(field_values)]
+        sums = np.add.reduceat(field_values, starts)
+        for bucket_start, start, end, total in zip(field_buckets[starts].tolist(), starts, ends, sums.tolist()):
+            segment = field_values[start:end]
+            results[(bucket_start if bucket_ns else None, field_name)] = {
+                "min": float(segment[0]),
+                "max": float(segment[-1]),
+                "sum": total,
+                "count": int(end - start),
+                "values": segment,
+            }
+    return results
+
+def statistic_values(stats, count, total, min_value, max_value, digest, sketch):
+    """The configured statistics from running totals and sketches."""
+    values = {"min": min_value, "max": max_value, "mean": total / count, "count": count}
+    if "median" in stats:
+        values["median"] = digest.quantile(0.5)
+    if "mode" in stats:
+        mode = sketch.mode()
+        values["mode"] = mode if mode is not None else 0
+    if "95Percentile" in stats:
+        values["95Percentile"] = digest.quantile(0.95)
+    return {stat: values[stat] for stat in stats}
+
+def aggregate_rolling(config, times_ns, columns, windows):
+    """
+    Fold one table batch into the rolling window of each field and build the window statistics of every touched field.
+
+    Returns:
+        list: (window end ns, analytics row dict) per touched field.
+    """
+    stats = config["stats"]
+    mode_capacity = config["mode_capacity"] if "mode" in stats else None
+    touched = []
+    panes = aggregate_buckets(times_ns, columns, config["pane_ns"])
+    for (pane_start, field_name), batch_stats in sorted(panes.items()):
+        window = windows.get(field_name)
+        if window is None or (window.window_ns, window.pane_ns) != (config["window_ns"], config["pane_ns"]):
+            window = windows[field_name] = RollingWindow(config["window_ns"], config["pane_ns"])
+        window.add(pane_start, batch_stats, config["mode_precision"], mode_capacity)
+        if field_name not in touched:
+            touched.append(field_name)
+
+    entries = []
+    for field_name in sorted(touched):
+        window = windows[field_name]
+        window_end = window.expire()
+        analytics_row = {"table_name": config["analytics_table"], "field_name": field_name,
+                         "window": config["window"], "window_end": bucket_label(window_end)}
+        analytics_row.update(window.statistics(stats))
+        entries.append((window_end, analytics_row))
+    return entries
+
+def aggregate_table(config, times_ns, columns, state):
+    """
+    Merge one table batch into its running state and build the updated statistics of every touched field and bucket.
+
+    Returns:
+        list: (bucket start ns or None, analytics row dict) per touched field and bucket, with the configured statistics.
+    """
+    stats = config["stats"]
+    entries = []
+    buckets = aggregate_buckets(times_ns, columns, config["bucket_ns"])
+    for (bucket_start, field_name), batch_stats in sorted(buckets.items(), key=lambda item: (item[0][0] or 0, item[0][1])):
+        mode_capacity = config["mode_capacity"] if "mode" in stats else None
+        entry, digest, sketch = merge_into_state(state, (bucket_start, field_name), batch_stats,
+                                                 config["mode_precision"], mode_capacity)
+        analytics_row = {"table_name": config["analytics_table"], "field_name": field_name}
+        if bucket_start is not None:
+            analytics_row["time_bucket"] = bucket_label(bucket_start)
+        analytics_row.update(statistic_values(stats, *entry[:4], digest, sketch))
+        entries.append((bucket_start, analytics_row))
+    return entries
+
 def process_writes(influxdb3_local, table_batches, args=None):
-    time_sampling = args.get("time_sampling") if args else None
-    time_bucket = time_sampling.split(" ")[-1] if time_sampling else None
-    time_bucket_size = parse_time_sampling(time_bucket) if time_bucket else None
+    configs = parse_table_configs(influxdb3_local, args)
+    state_retention = args.get("state_retention") if args else None
+    state_max_buckets = int(args.get("state_max_buckets", STATE_MAX_BUCKETS)) if args else STATE_MAX_BUCKETS
+    redis_ttl = args.get("redis_ttl") if args else None
+    redis_format = args.get("redis_format", "json") if args else "json"
+    redis_compression = args.get("redis_compression") if args else None
+    redis_legacy_key = (args.get("redis_legacy_key", "true") if args else "true") != "false"
+    if redis_compression == "none":
+        redis_compression = None
+    if redis_format == "arrow" and pa is None:
+        influxdb3_local.warn("redis_format=arrow needs pyarrow; publishing JSON instead")
+        redis_format = "json"
     database_name = args.get("database_name") if args else None
-    analytics_list = []
+    target_database = args.get("target_database") if args else None
+    states = {}
+    redis_entries = defaultdict(list)
+    analytics_lines = []
+    started = time.perf_counter()
+
+    # One pass over the flush: each batch's timestamps and fields are converted once, then aggregated for its table
     for table_batch in table_batches:
-        table_name = ""
-        if args and "table_name" in args:
-            table_name = args["table_name"]
-
-        if table_batch["table_name"] == table_name:
-            analytics_table = f"analytics_{table_name}"
-
-            try:
-                current_stats = influxdb3_local.query(f"SELECT * FROM {analytics_table}")
-                influxdb3_local.info("The current data are:", current_stats)
-                has_existing_stats = True
-
-                if isinstance(current_stats, list) and current_stats:
-                    current_stats = current_stats[0]  # Take first element if it's a list
-
-            except:
-                influxdb3_local.info("No data present!")
-                has_existing_stats = False
-                current_stats = {"min": {}, "max": {}, "sum": {}, "count": {}}
-
-            new_stats = {"min": {}, "max": {}, "sum": {}, "count": {}}
-            field_values_list = {}  # Store all values for advanced calculations
-
-            # Sort rows by the 'time' column
-            sorted_rows = sorted(table_batch["rows"], key=lambda row: parse_timestamp(row["time"]))
-
-            # Group data by time buckets if time_sampling is provided
-            if time_bucket_size:
-                time_buckets = defaultdict(lambda: {"values": defaultdict(list), "stats": {}})
-
-                for row in sorted_rows:  # Process rows in chronological order
-                    if "fields" in row:
-                        fields_dict = row["fields"]
-                    else:
-                        fields_dict = row
-
-                    # Extract and parse the timestamp
-                    try:
-                        timestamp = parse_timestamp(row["time"])
-                        bucket_start = timestamp - (timestamp - datetime.datetime.min) % time_bucket_size
-                    except Exception as e:
-                        influxdb3_local.error(f"Error parsing timestamp: {e}, Time value: {row['time']}, Type: {type(row['time'])}")
-                        continue
-
-                    for field_name, field_value in fields_dict.items():
-                        try:
-                            field_value = float(field_value)
-                        except:
-                            continue
-
-                        # Store values for median, mode, and 95th percentile
-                        time_buckets[bucket_start]["values"][field_name].append(field_value)
-
-                        # Update min, max, sum, and count for the time bucket
-                        if field_name not in time_buckets[bucket_start]["stats"]:
-                            time_buckets[bucket_start]["stats"][field_name] = {
-                                "min": field_value,
-                                "max": field_value,
-                                "sum": field_value,
-                                "count": 1,
-                            }
-                        else:
-                            bucket_stats = time_buckets[bucket_start]["stats"][field_name]
-                            bucket_stats["min"] = min(bucket_stats["min"], field_value)
-                            bucket_stats["max"] = max(bucket_stats["max"], field_value)
-                            bucket_stats["sum"] += field_value
-                            bucket_stats["count"] += 1
-
-                # Process each time bucket
-                for bucket_start, bucket_data in time_buckets.items():
-                    for field_name, values in bucket_data["values"].items():
-                        bucket_stats = bucket_data["stats"][field_name]
-
-                        min_value = bucket_stats["min"]
-                        max_value = bucket_stats["max"]
-                        mean_value = bucket_stats["sum"] / bucket_stats["count"]
-                        median_value = calculate_median(values)
-                        mode_value = calculate_mode(values)
-                        percentile_95 = calculate_percentile(values, 95)
-
-                        analytics_line = LineBuilder(analytics_table)\
-                            .tag("field_name", field_name)\
-                            .tag("time_bucket", bucket_start.isoformat())\
-                            .float64_field("min", min_value)\
-                            .float64_field("max", max_value)\
-                            .float64_field("mean", mean_value)\
-                            .float64_field("median", median_value)\
-                            .float64_field("mode", mode_value if mode_value is not None else 0)\
-                            .float64_field("95Percentile", percentile_95)\
-                            .float64_field("count", bucket_stats["count"])
-                        
-                        analytics_list.append({"table_name":analytics_table,
-                                               "field_name":field_name,
-                                               "time_bucket":bucket_start.isoformat(),
-                                               "min":min_value,
-                                               "max":max_value,
-                                               "mean":mean_value,
-                                               "median":median_value,
-                                               "mode":mode_value if mode_value is not None else 0,
-                                               "95Percentile":percentile_95,
-                                               "count":bucket_stats["count"]})
-                    
-                        influxdb3_local.write(analytics_line)
-                    analytics_data = pd.DataFrame(analytics_list)
-                    save_to_redis(analytics_data,analytics_table,database_name)
+        table_name = table_batch["table_name"]
+        config = configs.get(table_name)
+        if config is None:
+            continue
+        if table_name not in states:
+            if config["window"]:
+                # Rolling windows restart empty after a restart and refill as data arrives
+                states[table_name] = influxdb3_local.cache.get(f"{ROLLING_CACHE_PREFIX}:{config['analytics_table']}", default={})
             else:
-                # Process without time buckets (original logic)
-                for row in sorted_rows:  # Process rows in chronological order
-                    if "fields" in row:
-                        fields_dict = row["fields"]
-                    else:
-                        fields_dict = row
-
-                    for field_name, field_value in fields_dict.items():
-                        try:
-                            field_value = float(field_value)
-                        except:
-                            continue
-
-                        # Store values for median, mode, and 95th percentile
-                        if field_name not in field_values_list:
-                            field_values_list[field_name] = []
-                        field_values_list[field_name].append(field_value)
-
-                        new_stats["count"][field_name] = new_stats["count"].get(field_name, 0) + 1
-                        new_stats["sum"][field_name] = new_stats["sum"].get(field_name, 0) + field_value
-
-                        if field_name not in new_stats["min"] or field_value < new_stats["min"][field_name]:
-                            new_stats["min"][field_name] = field_value
-
-                        if field_name not in new_stats["max"] or field_value > new_stats["max"][field_name]:
-                            new_stats["max"][field_name] = field_value
-
-                if has_existing_stats:
-                    influxdb3_local.info("Table exists!")
-                    for field_name in new_stats["count"].keys():
-                        total_count = current_stats.get("count", {}).get(field_name, 0) + new_stats["count"][field_name]
-                        total_sum = current_stats.get("sum", {}).get(field_name, 0) + new_stats["sum"][field_name]
-
-                        min_value = min(
-                            current_stats.get("min", {}).get(field_name, float("inf")),
-                            new_stats["min"].get(field_name, float('inf'))
-                        )
-
-                        max_value = max(
-                            current_stats.get("max", {}).get(field_name, float('-inf')),
-                            new_stats["max"].get(field_name, float('-inf'))
-                        )
-
-                        mean_value = total_sum / total_count if total_count > 0 else 0
-                        median_value = calculate_median(field_values_list[field_name])
-                        mode_value = calculate_mode(field_values_list[field_name])
-                        percentile_95 = calculate_percentile(field_values_list[field_name], 95)
-
-                        analytics_line = LineBuilder(analytics_table)\
-                            .tag("field_name", field_name)\
-                            .float64_field("min", min_value)\
-                            .float64_field("max", max_value)\
-                            .float64_field("mean", mean_value)\
-                            .float64_field("median", median_value)\
-                            .float64_field("mode", mode_value if mode_value is not None else 0)\
-                            .float64_field("95Percentile", percentile_95)\
-                            .float64_field("count", total_count)
-                        
-                        analytics_list.append({"table_name":analytics_table,
-                                               "field_name":field_name,
-                                               "min":min_value,
-                                               "max":max_value,
-                                               "mean":mean_value,
-                                               "median":median_value,
-                                               "mode":mode_value if mode_value is not None else 0,
-                                               "95Percentile":percentile_95,
-                                               "count":bucket_stats[count]})
-                        
-
-                        influxdb3_local.write(analytics_line)
-                    analytics_data = pd.DataFrame(analytics_line)
-                    save_to_redis(analytics_data,analytics_table,database_name)
-
-                else:
-                    influxdb3_local.info("Table does not exist!")
-                    for field_name in new_stats["count"].keys():
-                        count = new_stats["count"][field_name]
-                        min_value = new_stats["min"][field_name]
-                        max_value = new_stats["max"][field_name]
-                        mean_value = new_stats["sum"][field_name] / count if count > 0 else 0
-                        median_value = calculate_median(field_values_list[field_name])
-                        mode_value = calculate_mode(field_values_list[field_name])
-                        percentile_95 = calculate_percentile(field_values_list[field_name], 95)
-
-                        analytics_line = LineBuilder(analytics_table)\
-                            .tag("field_name", field_name)\
-                            .float64_field("min", min_value)\
-                            .float64_field("max", max_value)\
-                            .float64_field("mean", mean_value)\
-                            .float64_field("median", median_value)\
-                            .float64_field("mode", mode_value if mode_value is not None else 0)\
-                            .float64_field("95th_percentile", percentile_95)\
-                            .float64_field("count", count)
-
-                        analytics_list.append({"table_name":analytics_table,
-                                               "field_name":field_name,
-                                               "min":min_value,
-                                               "max":max_value,
-                                               "mean":mean_value,
-                                               "median":median_value,
-                                               "mode":mode_value if mode_value is not None else 0,
-                                               "95Percentile":percentile_95,
-                                               "count":bucket_stats[count]})
-                        
-                        influxdb3_local.write(analytics_line)
-                    analytics_data = pd.DataFrame(analytics_line)
-                    save_to_redis(analytics_data,analytics_table,database_name)
-
-    influxdb3_local.info("Analytics data collected with median, mode, and 95th percentile!")
\ No newline at end of file
+                states[table_name] = load_state(influxdb3_local, config["analytics_table"], config["mode_capacity"])
+
+        try:
+            times_ns, columns = batch_to_columns(table_batch["rows"], config["fields"])
+        except (TypeError, ValueError) as e:
+            influxdb3_local.error(f"Error parsing timestamps: {e}")
+            continue
+
+        aggregate = aggregate_rolling if config["window"] else aggregate_table
+        for bucket_start, analytics_row in aggregate(config, times_ns, columns, states[table_name]):
+            analytics_line = LineBuilder(config["analytics_table"])\
+                .tag("field_name", analytics_row["field_name"])
+            if "time_bucket" in analytics_row:
+                analytics_line.tag("time_bucket", analytics_row["time_bucket"])
+            if "window" in analytics_row:
+                analytics_line.tag("window", analytics_row["window"]).time_ns(bucket_start)
+            for stat in config["stats"]:
+                analytics_line.float64_field(stat, analytics_row[stat])
+            analytics_lines.append(analytics_line)
+            redis_entries[table_name].append((bucket_start, analytics_row))
+
+    aggregated = time.perf_counter()
+
+    # Emit everything in one go once aggregation is done; the engine buffers the lines of an
+    # invocation and commits them together, so this is a single batched write per flush
+    for analytics_line in analytics_lines:
+        if target_database:
+            influxdb3_local.write_to_db(target_database, analytics_line)
+        else:
+            influxdb3_local.write(analytics_line)
+    written = time.perf_counter()
+
+    for table_name, state in states.items():
+        config = configs[table_name]
+        if config["window"]:
+            influxdb3_local.cache.put(f"{ROLLING_CACHE_PREFIX}:{config['analytics_table']}", state)
+        else:
+            if config["bucket_ns"]:
+                prune_state(state, duration_ns(state_retention) if state_retention else None, state_max_buckets)
+            influxdb3_local.cache.put(f"{STATE_CACHE_PREFIX}:{config['analytics_table']}", state)
+
+    # Every table of the flush is published in one pipelined round trip (plus one read for Arrow)
+    publish = {configs[table_name]["analytics_table"]: entries for table_name, entries in redis_entries.items() if entries}
+    if publish:
+        try:
+            stored = read_arrow_buckets(publish, database_name) if redis_format == "arrow" else {}
+            pipe = redis_client.pipeline(transaction=False)
+            for analytics_table, entries in publish.items():
+                save_to_redis(pipe, entries, analytics_table, database_name, duration_ns(redis_ttl) if redis_ttl else None,
+                              redis_format, redis_compression, redis_legacy_key, stored.get(analytics_table))
+            pipe.execute()
+        except redis.RedisError as e:
+            influxdb3_local.warn(f"Could not publish analytics to Redis: {e}")
+
+    published = time.perf_counter()
+
+    influxdb3_local.info(f"Analytics data collected for {len(states)} table(s): {len(analytics_lines)} rows, "
+                         f"aggregation {(aggregated - started) * 1000:.1f} ms, write {(written - aggregated) * 1000:.1f} ms, "
+                         f"cache and Redis {(published - written) * 1000:.1f} ms")
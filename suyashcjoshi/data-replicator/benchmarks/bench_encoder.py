@@ -0,0 +1,83 @@
+# Line protocol encoder benchmark for the Data Replicator Plugin
+# Copyright (c) 2025 InfluxData Inc.
+#
+# Compares the per-row row_to_line_protocol() against the batch
+# encode_table_batch() on synthetic table batches and reports rows/sec.
+# Requires the plugin's own dependency (influxdb3-python) to be importable.
+#
+#   python benchmarks/bench_encoder.py --rows 100000 --tags 4 --fields 8
+
+import argparse
+import importlib.util
+import random
+import time
+from pathlib import Path
+
+PLUGIN_PATH = Path(__file__).resolve().parent.parent / "data-replicator.py"
+
+
+def load_plugin():
+    """Import data-replicator.py (its file name is not a valid module name)."""
+    spec = importlib.util.spec_from_file_location("data_replicator", PLUGIN_PATH)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def make_rows(count, tag_count, field_count, cardinality, seed=42):
+    """Generate WAL-style rows with string tags and a mix of float, int and bool fields."""
+    rng = random.Random(seed)
+    base_ns = 1743441600000000000
+    rows = []
+    for i in range(count):
+        row = {"time": base_ns + i * 1_000_000}
+        for t in range(tag_count):
+            row[f"tag{t}"] = f"value-{rng.randrange(cardinality)}"
+        for f in range(field_count):
+            kind = f % 3
+            if kind == 0:
+                row[f"field{f}"] = rng.random() * 100
+            elif kind == 1:
+                row[f"field{f}"] = rng.randrange(1 << 31)
+            else:
+                row[f"field{f}"] = rng.random() < 0.5
+        rows.append(row)
+    return rows
+
+
+def bench(label, fn, rows, repeat):
+    """Run fn() `repeat` times and print the best rows/sec."""
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        best = min(best, time.perf_counter() - start)
+    print(f"{label:<24} {len(rows) / best:>14,.0f} rows/sec  ({best * 1000:.1f} ms)")
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the replicator line protocol encoders")
+    parser.add_argument("--rows", type=int, default=100_000)
+    parser.add_argument("--tags", type=int, default=3)
+    parser.add_argument("--fields", type=int, default=6)
+    parser.add_argument("--cardinality", type=int, default=50)
+    parser.add_argument("--repeat", type=int, default=3)
+    opts = parser.parse_args()
+
+    plugin = load_plugin()
+    rows = make_rows(opts.rows, opts.tags, opts.fields, opts.cardinality)
+
+    per_row = [plugin.row_to_line_protocol("bench", row) for row in rows]
+    batch = plugin.encode_table_batch("bench", rows)
+    if per_row != batch:
+        raise SystemExit("encode_table_batch output differs from row_to_line_protocol")
+
+    print(f"{opts.rows:,} rows, {opts.tags} tags, {opts.fields} fields, tag cardinality {opts.cardinality}")
+    slow = bench("row_to_line_protocol", lambda: [plugin.row_to_line_protocol("bench", row) for row in rows], rows, opts.repeat)
+    fast = bench("encode_table_batch", lambda: plugin.encode_table_batch("bench", rows), rows, opts.repeat)
+    print(f"speedup: {slow / fast:.1f}x")
+
+
+if __name__ == "__main__":
+    main()
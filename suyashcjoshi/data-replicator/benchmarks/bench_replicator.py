@@ -0,0 +1,262 @@
+# End-to-end replicator benchmark for the Data Replicator Plugin
+# Copyright (c) 2025 InfluxData Inc.
+#
+# Drives process_writes() (and optionally process_scheduled_call()) with
+# synthetic table batches against an in-memory stand-in for influxdb3_local
+# and a fake remote client that can inject latency, 429s and failures, then
+# reports rows/sec, flush latency percentiles, remote requests and queue I/O.
+# No InfluxDB instance is needed, but the plugin's own dependency
+# (influxdb3-python) must be importable.
+#
+#   python benchmarks/bench_replicator.py --tables 3 --rows 2000 --flushes 50
+#   python benchmarks/bench_replicator.py --transport arrow --latency-ms 20 --throttle-rate 0.05
+
+import argparse
+import os
+import random
+import tempfile
+import time
+from pathlib import Path
+
+from bench_encoder import load_plugin
+
+
+class FakeLineBuilder:
+    """Minimal stand-in for the engine's LineBuilder global."""
+
+    def __init__(self, measurement):
+        self.measurement = measurement
+        self.tags = {}
+        self.fields = {}
+
+    def tag(self, key, value):
+        self.tags[key] = value
+        return self
+
+    def _field(self, key, value):
+        self.fields[key] = value
+        return self
+
+    int64_field = uint64_field = float64_field = string_field = bool_field = _field
+
+    def time_ns(self, timestamp):
+        self.timestamp = timestamp
+        return self
+
+
+class FakeCache:
+    def __init__(self):
+        self.data = {}
+
+    def get(self, key, default=None):
+        return self.data.get(key, default)
+
+    def put(self, key, value, ttl=None):
+        self.data[key] = value
+
+
+class FakeLocal:
+    """In-memory influxdb3_local: cache, logging, and captured local writes."""
+
+    def __init__(self, verbose=False):
+        self.cache = FakeCache()
+        self.verbose = verbose
+        self.errors = 0
+        self.written = []
+
+    def info(self, *args):
+        if self.verbose:
+            print("INFO", *args)
+
+    def warn(self, *args):
+        if self.verbose:
+            print("WARN", *args)
+
+    def error(self, *args):
+        self.errors += 1
+        if self.verbose:
+            print("ERROR", *args)
+
+    def write(self, line_builder, *args, **kwargs):
+        self.written.append(line_builder)
+
+    def query(self, *args, **kwargs):
+        return []
+
+
+class FakeResponse:
+    """Just enough of an HTTP response for InfluxDBError and the plugin's 429 handling."""
+
+    def __init__(self, status, reason, headers=None):
+        self.status = status
+        self.reason = reason
+        self.headers = headers or {}
+        self.data = b""
+
+    def getheader(self, key, default=None):
+        return self.headers.get(key, default)
+
+
+def make_fake_client(plugin, latency, throttle_rate, failure_rate, retry_after, seed):
+    """Build a fake InfluxDBClient3 class sharing counters across instances."""
+    rng = random.Random(seed)
+
+    class FakeClient:
+        requests = 0
+        rows = 0
+        throttled = 0
+        failed = 0
+
+        def __init__(self, host=None, token=None, database=None, **kwargs):
+            self.host = host
+
+        def write(self, record=None, **kwargs):
+            cls = FakeClient
+            cls.requests += 1
+            if latency:
+                time.sleep(latency)
+            roll = rng.random()
+            if roll < throttle_rate:
+                cls.throttled += 1
+                raise plugin.InfluxDBError(response=FakeResponse(429, "Too Many Requests", {"retry-after": str(retry_after)}))
+            if roll < throttle_rate + failure_rate:
+                cls.failed += 1
+                raise plugin.InfluxDBError(response=FakeResponse(503, "Service Unavailable"))
+            cls.rows += len(record)
+
+        def query(self, *args, **kwargs):
+            raise RuntimeError("the fake remote does not support queries (run with validate=false)")
+
+        def close(self):
+            pass
+
+    return FakeClient
+
+
+def instrument_queue_io(plugin):
+    """Wrap the queue segment formats and cursor writes to count queue file I/O."""
+    io = {"appends": 0, "bytes_written": 0, "records_read": 0, "bytes_read": 0, "cursor_writes": 0}
+    formats = list(plugin._SEGMENT_FORMATS.values()) + list(getattr(plugin, "_ARROW_SEGMENT_FORMATS", {}).values())
+    for fmt in set(formats):
+        append, iter_records = fmt.append, fmt.iter_records
+
+        def counted_append(path, records, append=append):
+            before = os.path.getsize(path) if os.path.exists(path) else 0
+            append(path, records)
+            io["appends"] += 1
+            io["bytes_written"] += os.path.getsize(path) - before
+
+        def counted_iter_records(path, offset, iter_records=iter_records):
+            for record, resume in iter_records(path, offset):
+                io["records_read"] += 1
+                io["bytes_read"] += len(record)
+                yield record, resume
+
+        fmt.append = counted_append
+        fmt.iter_records = counted_iter_records
+
+    store_cursor = plugin.SegmentedQueue._store_cursor
+
+    def counted_store_cursor(queue, *args):
+        io["cursor_writes"] += 1
+        return store_cursor(queue, *args)
+
+    plugin.SegmentedQueue._store_cursor = counted_store_cursor
+    return io
+
+
+def make_table_batches(rng, flush, tables, rows, tags, cardinality, fields):
+    """Generate one WAL flush worth of table batches with increasing timestamps."""
+    base_ns = time.time_ns() + flush * 1_000_000_000
+    batches = []
+    for t in range(tables):
+        batch_rows = []
+        for i in range(rows):
+            row = {"time": base_ns + i * 1000}
+            for g in range(tags):
+                row[f"tag{g}"] = f"value-{rng.randrange(cardinality)}"
+            for f in range(fields):
+                kind = f % 3
+                if kind == 0:
+                    row[f"field{f}"] = rng.random() * 100
+                elif kind == 1:
+                    row[f"field{f}"] = rng.randrange(1 << 31)
+                else:
+                    row[f"field{f}"] = rng.random() < 0.5
+            batch_rows.append(row)
+        batches.append({"table_name": f"table{t}", "rows": batch_rows})
+    return batches
+
+
+def percentile(sorted_values, pct):
+    return sorted_values[min(int(len(sorted_values) * pct / 100), len(sorted_values) - 1)]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark process_writes against a fake local API and remote")
+    parser.add_argument("--tables", type=int, default=3)
+    parser.add_argument("--rows", type=int, default=1000, help="rows per table per flush")
+    parser.add_argument("--flushes", type=int, default=50)
+    parser.add_argument("--tags", type=int, default=3)
+    parser.add_argument("--cardinality", type=int, default=100)
+    parser.add_argument("--fields", type=int, default=6)
+    parser.add_argument("--latency-ms", type=float, default=0.0, help="fake remote write latency")
+    parser.add_argument("--throttle-rate", type=float, default=0.0, help="fraction of writes answered with 429")
+    parser.add_argument("--failure-rate", type=float, default=0.0, help="fraction of writes that fail")
+    parser.add_argument("--retry-after", type=int, default=0, help="retry-after seconds sent with 429s")
+    parser.add_argument("--drain-mode", choices=["inline", "scheduled"], default="inline")
+    parser.add_argument("--drain-every", type=int, default=10, help="flushes per scheduled drain (drain-mode=scheduled)")
+    parser.add_argument("--arg", action="append", default=[], metavar="KEY=VALUE",
+                        help="extra trigger argument, e.g. --arg transport=arrow --arg queue_compression=zlib")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--verbose", action="store_true")
+    opts = parser.parse_args()
+
+    plugin = load_plugin()
+    work_dir = Path(tempfile.mkdtemp(prefix="edr_bench_"))
+    plugin.QUEUE_DIR = work_dir / "edr_queue"
+    plugin.QUEUE_FILE = work_dir / "edr_queue.jsonl"
+    plugin.LineBuilder = FakeLineBuilder
+    client_class = make_fake_client(plugin, opts.latency_ms / 1000, opts.throttle_rate, opts.failure_rate,
+                                    opts.retry_after, opts.seed)
+    plugin.InfluxDBClient3 = client_class
+    io = instrument_queue_io(plugin)
+
+    args = {"host": "http://fake", "token": "fake", "database": "bench", "filters": "none", "drain_mode": opts.drain_mode}
+    args.update(item.split("=", 1) for item in opts.arg)
+    local = FakeLocal(opts.verbose)
+    rng = random.Random(opts.seed)
+
+    flush_times = []
+    total_rows = 0
+    start = time.perf_counter()
+    for flush in range(opts.flushes):
+        batches = make_table_batches(rng, flush, opts.tables, opts.rows, opts.tags, opts.cardinality, opts.fields)
+        total_rows += sum(len(batch["rows"]) for batch in batches)
+        flush_start = time.perf_counter()
+        plugin.process_writes(local, batches, args)
+        flush_times.append(time.perf_counter() - flush_start)
+        if opts.drain_mode == "scheduled" and (flush + 1) % opts.drain_every == 0:
+            plugin.process_scheduled_call(local, None, args)
+    if opts.drain_mode == "scheduled":
+        plugin.process_scheduled_call(local, None, args)
+    elapsed = time.perf_counter() - start
+
+    queue = plugin.get_queue(plugin.QUEUE_DIR)
+    flush_times.sort()
+    print(f"{opts.flushes} flushes x {opts.tables} tables x {opts.rows:,} rows, {opts.tags} tags "
+          f"(cardinality {opts.cardinality}), {opts.fields} fields, args {args}")
+    print(f"throughput       {total_rows / elapsed:>14,.0f} rows/sec  ({total_rows:,} rows in {elapsed:.2f} s)")
+    print(f"flush latency    p50 {percentile(flush_times, 50) * 1000:.1f} ms  p95 {percentile(flush_times, 95) * 1000:.1f} ms  "
+          f"p99 {percentile(flush_times, 99) * 1000:.1f} ms  max {flush_times[-1] * 1000:.1f} ms")
+    print(f"remote           {client_class.rows:,} rows in {client_class.requests:,} requests  "
+          f"({client_class.throttled} throttled, {client_class.failed} failed)")
+    print(f"queue I/O        {io['appends']:,} appends, {io['bytes_written'] / 1e6:.2f} MB written, "
+          f"{io['records_read']:,} records / {io['bytes_read'] / 1e6:.2f} MB read, {io['cursor_writes']:,} cursor writes")
+    print(f"queue backlog    {queue.depth():,} lines, {queue.pending_bytes() / 1e6:.2f} MB  (queue in {work_dir})")
+    if local.errors:
+        print(f"plugin errors    {local.errors} (rerun with --verbose for details)")
+
+
+if __name__ == "__main__":
+    main()
@@ -5,60 +5,708 @@ import os
 import json
 import time
 import hashlib
+import gzip
+import zlib
+import struct
+import re
+import operator
+import threading
+import itertools
+import contextlib
 from pathlib import Path
 from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+import pyarrow as pa
 from influxdb_client_3 import InfluxDBClient3, InfluxDBError
 
+try:
+    import fcntl  # Cross-process queue locking; unavailable on Windows
+except ImportError:
+    fcntl = None
+
 # Configuration
 try:
     PLUGIN_DIR = Path(__file__).parent
 except NameError:
     PLUGIN_DIR = Path(os.getenv("PLUGIN_DIR", os.path.expanduser("~/.plugins")))
-QUEUE_FILE = PLUGIN_DIR / "edr_queue.jsonl"  # Plain text queue file (no compression)
+QUEUE_FILE = PLUGIN_DIR / "edr_queue.jsonl"  # Legacy single-file queue, migrated on first use
+QUEUE_DIR = PLUGIN_DIR / "edr_queue"  # Segmented append-only queue (JSONL or Arrow IPC segments)
+CURSOR_FILE = "cursor.json"  # Committed-offset cursor of the default destination inside QUEUE_DIR
+QUEUE_LOCK_FILE = "queue.lock"  # flock()ed inside QUEUE_DIR around appends, repairs and cursor updates
+DEFAULT_CURSOR = "default"  # Cursor (destination) name used when only host/token/database are given
+DEFAULT_SEGMENT_MAX_BYTES = 16 * 1024 * 1024  # Roll to a new segment once the active one reaches this size
+DEFAULT_MAX_LINES_PER_WRITE = 5000  # Upper bound on lines per remote write request
+DEFAULT_MAX_BYTES_PER_WRITE = 4 * 1024 * 1024  # Upper bound on payload bytes per remote write request
+DEFAULT_MIN_LINES_PER_WRITE = 100  # Floor for the adaptive batch size
+TAG_MEMO_MAX_ENTRIES = 10000  # Escaped values memoized per tag column before the memo is reset
+DEFAULT_MAX_REQUESTS_PER_SECOND = 20.0  # Ceiling for the adaptive request rate
+MIN_REQUESTS_PER_SECOND = 0.1
+AIMD_INCREASE_FRACTION = 0.05  # Additive step per accepted request, as a fraction of the ceiling
+AIMD_DECREASE_FACTOR = 0.5  # Multiplicative cut on 429s, failures and latency spikes
+LATENCY_SPIKE_FACTOR = 3.0  # A request this many times slower than average counts as congestion
+LATENCY_EWMA_ALPHA = 0.2
+DEFAULT_FILTERS = "cpu.cpu==cpu-total"  # Replicate only the cpu-total series of Telegraf's cpu table
 STATE_KEY = "last_replicated_timestamp"  # Cache key for tracking replication progress
+DOWNSAMPLE_STATE_KEY = "downsample_state"  # Cache key for open downsampling buckets and watermark
+STATS_MEASUREMENT = "replicator_stats"  # Local table the replicator writes its own metrics to
+FLOW_STATE_KEY = "flow_control"  # Cache key for adaptive batch size and request rate
+DRAIN_BACKOFF_KEY = "drain_backoff"  # Cache key for a destination's cross-call drain backoff
+MAX_DRAIN_BACKOFF_SECONDS = 300
 
 # Custom timestamp (in nanoseconds) for testing
 # 2025-03-31T12:00:00Z = 1743441600000000000 nanoseconds
 CUSTOM_TIMESTAMP_NS = 1743441600000000000
 
+# Length prefix of each compressed queue segment frame
+_FRAME_HEADER = struct.Struct(">I")
 
-def ensure_queue_file():
-    """Ensure the queue file directory exists."""
-    if not QUEUE_FILE.parent.exists():
-        QUEUE_FILE.parent.mkdir(parents=True)
+# Open queues keyed by directory, so the next sequence number survives across WAL flushes
+_QUEUES = {}
 
+# Compiled table lists and row filters keyed by the raw (tables, filters) arguments
+_FILTERS = {}
 
-def append_to_queue(entries):
-    """Append entries to the queue file (JSON-serializable data only)."""
-    ensure_queue_file()
-    with open(QUEUE_FILE, "a", encoding="utf-8") as f:
-        for entry in entries:
-            # Only store serializable fields (table, line, checksum)
-            queue_entry = {"table": entry["table"], "line": entry["line"]}
-            if "checksum" in entry:
-                queue_entry["checksum"] = entry["checksum"]
-            f.write(json.dumps(queue_entry) + "\n")
+# Remote clients keyed by (host, database) -> (token, client), so connections are reused across WAL flushes
+_CLIENTS = {}
 
+# Line protocol encoding plans keyed by (table name, column names), reused across table batches
+_SCHEMAS = {}
 
-def read_queue():
-    """Read all lines from the queue file."""
-    ensure_queue_file()
-    if not QUEUE_FILE.exists():
-        return []
-    with open(QUEUE_FILE, "r", encoding="utf-8") as f:
-        return [json.loads(line.strip()) for line in f if line.strip()]
+# Line protocol escaping (measurement names; tag keys, tag values and field keys; string field values)
+_ESCAPE_MEASUREMENT = str.maketrans({",": "\\,", " ": "\\ ", "\n": "\\n"})
+_ESCAPE_KEY = str.maketrans({",": "\\,", "=": "\\=", " ": "\\ ", "\n": "\\n"})
+_ESCAPE_STRING = str.maketrans({"\\": "\\\\", '"': '\\"'})
+_UNESCAPED_SPACE = re.compile(r"(?<!\\) ")
+
+# Duration strings for aggregate_interval / aggregate_lateness (e.g. "30s", "1m", "2h")
+_DURATION = re.compile(r"(\d+)(ns|us|ms|s|m|h|d)")
+_DURATION_UNITS = {
+    "ns": 1,
+    "us": 1_000,
+    "ms": 1_000_000,
+    "s": 1_000_000_000,
+    "m": 60 * 1_000_000_000,
+    "h": 3600 * 1_000_000_000,
+    "d": 86400 * 1_000_000_000,
+}
+
+# Row filter predicates: "<table>.<column><op><value>" or "<table>.<column> [not ]in <v1>|<v2>"
+_PREDICATE = re.compile(r"^\s*([^.\s]+)\.(\S+?)\s*(==|!=|=~|!~|>=|<=|>|<|\s+not\s+in\s+|\s+in\s+)\s*(.*?)\s*$")
+_NUMERIC_OPS = {">": operator.gt, ">=": operator.ge, "<": operator.lt, "<=": operator.le}
+
+# Downsampling aggregates over a field's [count, sum, min, max, last, last_time] state
+_AGGREGATES = {
+    "avg": lambda s: s[1] / s[0],
+    "min": lambda s: s[2],
+    "max": lambda s: s[3],
+    "sum": lambda s: s[1],
+    "count": lambda s: s[0],
+    "last": lambda s: s[4],
+}
+
+# Field value formatters by Python type
+_FIELD_FORMATTERS = {
+    bool: lambda v: "true" if v else "false",
+    int: lambda v: f"{v}i",  # Explicitly mark integers
+    float: repr,
+}
+
+
+class _PlainSegments:
+    """Segment format: one JSON entry per line, uncompressed."""
+
+    suffix = ".jsonl"
+
+    @staticmethod
+    def encode(entry):
+        return json.dumps(entry).encode("utf-8")
+
+    @staticmethod
+    def decode(record):
+        return json.loads(record)
+
+    @staticmethod
+    def append(path, records):
+        with open(path, "ab") as f:
+            f.write(b"\n".join(records) + b"\n")
+
+    @staticmethod
+    def iter_records(path, offset):
+        """Yield (record, offset just past it) starting at `offset`."""
+        with open(path, "rb") as f:
+            f.seek(offset)
+            for raw in f:
+                if not raw.endswith(b"\n"):
+                    break  # Incomplete line still being written
+                offset += len(raw)
+                yield raw, offset
+
+    @staticmethod
+    def last_record(path):
+        """Read the last newline-terminated line of a file by scanning backwards from its end."""
+        with open(path, "rb") as f:
+            f.seek(0, os.SEEK_END)
+            pos = f.tell()
+            buf = b""
+            while pos > 0:
+                step = min(65536, pos)
+                pos -= step
+                f.seek(pos)
+                buf = f.read(step) + buf
+                end = buf.rfind(b"\n")  # Anything after it is an append still in progress
+                if end == -1:
+                    continue
+                start = buf.rfind(b"\n", 0, end)
+                if start != -1 or pos == 0:
+                    return buf[start + 1:end] or None
+            return None
+
+    @staticmethod
+    def repair(path):
+        """Drop a partially written final line left behind by a crash mid-append."""
+        with open(path, "rb+") as f:
+            f.seek(0, os.SEEK_END)
+            size = f.tell()
+            if size == 0:
+                return
+            f.seek(size - 1)
+            if f.read(1) == b"\n":
+                return
+            pos = size
+            while pos > 0:
+                step = min(65536, pos)
+                pos -= step
+                f.seek(pos)
+                idx = f.read(step).rfind(b"\n")
+                if idx != -1:
+                    f.truncate(pos + idx + 1)
+                    return
+            f.truncate(0)
+
+
+class _FramedSegments:
+    """
+    Segment format: compressed blocks of JSON lines, one block per append.
+
+    Each frame is a 4-byte big-endian payload length followed by the
+    compressed payload, so frames can be skipped without decompressing them
+    and decoded one at a time while streaming through a segment.
+    """
+
+    encode = staticmethod(_PlainSegments.encode)
+    decode = staticmethod(_PlainSegments.decode)
+
+    def __init__(self, suffix, compress, decompress):
+        self.suffix = suffix
+        self.compress = compress
+        self.decompress = decompress
+
+    def append(self, path, records):
+        payload = self.compress(b"\n".join(records) + b"\n")
+        with open(path, "ab") as f:
+            f.write(_FRAME_HEADER.pack(len(payload)) + payload)
+
+    @staticmethod
+    def _frames(f, offset):
+        """Yield (frame start, frame end, payload) for every complete frame from `offset`."""
+        f.seek(offset)
+        while True:
+            header = f.read(_FRAME_HEADER.size)
+            if len(header) < _FRAME_HEADER.size:
+                return
+            (length,) = _FRAME_HEADER.unpack(header)
+            payload = f.read(length)
+            if len(payload) < length:
+                return  # Incomplete frame still being written
+            start = offset
+            offset += _FRAME_HEADER.size + length
+            yield start, offset, payload
+
+    @staticmethod
+    def _last_frame(f):
+        """
+        Return (start, end) of the last complete frame, or (None, 0) if there is none.
+
+        Only the headers are read: payloads are skipped with a seek, and a frame
+        running past the end of the file (still being written) is not counted.
+        """
+        size = f.seek(0, os.SEEK_END)
+        f.seek(0)
+        start, end = None, 0
+        while True:
+            header = f.read(_FRAME_HEADER.size)
+            if len(header) < _FRAME_HEADER.size:
+                break
+            (length,) = _FRAME_HEADER.unpack(header)
+            if end + _FRAME_HEADER.size + length > size:
+                break
+            start, end = end, end + _FRAME_HEADER.size + length
+            f.seek(length, os.SEEK_CUR)
+        return start, end
+
+    @classmethod
+    def _last_payload(cls, path):
+        """Read the payload of the last complete frame in a segment, or None."""
+        with open(path, "rb") as f:
+            start, end = cls._last_frame(f)
+            if start is None:
+                return None
+            f.seek(start + _FRAME_HEADER.size)
+            return f.read(end - start - _FRAME_HEADER.size)
+
+    def iter_records(self, path, offset):
+        """
+        Yield (record, resume offset) starting at the frame at `offset`.
+
+        A frame can only be resumed from its start, so every record but the
+        last in a frame resumes at the frame start; the caller skips records
+        that were already committed by sequence number.
+        """
+        with open(path, "rb") as f:
+            for start, end, payload in self._frames(f, offset):
+                records = self.decompress(payload).splitlines()
+                for i, record in enumerate(records):
+                    yield record, end if i == len(records) - 1 else start
+
+    def last_record(self, path):
+        last = self._last_payload(path)
+        return self.decompress(last).splitlines()[-1] if last else None
+
+    def repair(self, path):
+        """Drop a partially written final frame left behind by a crash mid-append."""
+        with open(path, "rb+") as f:
+            f.truncate(self._last_frame(f)[1])
+
+
+class _ArrowSegments(_FramedSegments):
+    """
+    Segment format: one Arrow IPC stream per queued table batch (transport=arrow).
+
+    Frames use the same length prefix as _FramedSegments but hold a single
+    entry each: the batch's columns, with the entry's queue metadata (seq,
+    table, tags, rows, queued_at) stored as JSON in the schema metadata.
+    Buffers are optionally compressed by Arrow itself, which the reader
+    detects on its own.
+    """
+
+    def __init__(self, compression=None):
+        super().__init__(".arrows", None, None)
+        self.options = pa.ipc.IpcWriteOptions(compression=compression)
+
+    def encode(self, entry):
+        metadata = {key: value for key, value in entry.items() if key != "batch"}
+        batch = entry["batch"].replace_schema_metadata({"entry": json.dumps(metadata)})
+        sink = pa.BufferOutputStream()
+        with pa.ipc.new_stream(sink, batch.schema, options=self.options) as writer:
+            writer.write_table(batch)
+        return sink.getvalue().to_pybytes()
+
+    @staticmethod
+    def decode(record):
+        batch = pa.ipc.open_stream(record).read_all()
+        entry = json.loads(batch.schema.metadata[b"entry"])
+        entry["batch"] = batch.replace_schema_metadata(None)
+        return entry
+
+    def append(self, path, records):
+        with open(path, "ab") as f:
+            f.write(b"".join(_FRAME_HEADER.pack(len(record)) + record for record in records))
+
+    def iter_records(self, path, offset):
+        """Yield (record, offset of the next frame) starting at the frame at `offset`."""
+        with open(path, "rb") as f:
+            for _, end, payload in self._frames(f, offset):
+                yield payload, end
+
+    def last_record(self, path):
+        return self._last_payload(path)
+
+
+# Segment formats by queue_compression setting, and by file suffix when reading
+_SEGMENT_FORMATS = {
+    "none": _PlainSegments(),
+    "zlib": _FramedSegments(".jsonl.zlib", lambda data: zlib.compress(data, 6), zlib.decompress),
+    "gzip": _FramedSegments(".jsonl.gz", lambda data: gzip.compress(data, 6), gzip.decompress),
+}
+_SEGMENT_SUFFIXES = {fmt.suffix: fmt for fmt in _SEGMENT_FORMATS.values()}
+
+# Arrow IPC segments for transport=arrow, by queue_compression (zlib/gzip map to Arrow's zstd buffer compression)
+_ARROW_COMPRESSION = "zstd" if pa.Codec.is_available("zstd") else None
+_ARROW_SEGMENT_FORMATS = {
+    "none": _ArrowSegments(),
+    "zlib": _ArrowSegments(_ARROW_COMPRESSION),
+    "gzip": _ArrowSegments(_ARROW_COMPRESSION),
+}
+_SEGMENT_SUFFIXES[_ARROW_SEGMENT_FORMATS["none"].suffix] = _ARROW_SEGMENT_FORMATS["none"]
+
+
+@contextlib.contextmanager
+def _file_lock(path, blocking=True):
+    """
+    Hold an exclusive flock() on `path` (created if missing).
+
+    The WAL and schedule triggers each load their own copy of this module, so
+    threading locks alone cannot coordinate them. Yields False instead of
+    waiting when `blocking` is False and another process holds the lock.
+    Without fcntl (Windows) this only yields True.
+    """
+    if fcntl is None:
+        yield True
+        return
+    with open(path, "a") as f:
+        try:
+            fcntl.flock(f, fcntl.LOCK_EX | (0 if blocking else fcntl.LOCK_NB))
+        except BlockingIOError:
+            yield False
+            return
+        try:
+            yield True
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+class SegmentedQueue:
+    """
+    Durable append-only queue stored as rolling segment files.
+
+    Every entry is assigned a monotonically increasing sequence number ("seq").
+    Segments are named after the first sequence number they contain, and a
+    cursor file records the last committed sequence number together with the
+    segment and byte offset to resume from. Appending writes only the new
+    entries, reading seeks straight to the cursor, and committing rewrites
+    only the small cursor file, so every operation costs O(batch) rather than
+    O(queue).
+
+    Each consumer (replication destination) has its own named cursor, so one
+    copy of the data feeds several destinations that advance independently.
+    Segments are deleted once they lie behind every cursor in use; a cursor
+    seen for the first time starts at the current end of the queue.
+
+    Segments hold JSON lines, either plain or as compressed frames (one per
+    append) depending on `compression`, or Arrow IPC frames for entries that
+    carry a columnar 'batch' (transport=arrow). Switching format rolls to a
+    new segment, and older segments keep being read in their own format.
+
+    Appends, crash repair and cursor updates hold an flock() on QUEUE_LOCK_FILE,
+    and each cursor is drained under its own non-blocking flock(), so the WAL
+    and schedule triggers (separate module copies) never drain the same cursor
+    at once or truncate a record the other is still appending.
+    """
+
+    def __init__(self, directory, segment_max_bytes=DEFAULT_SEGMENT_MAX_BYTES, compression="none",
+                 cursors=(DEFAULT_CURSOR,)):
+        self.directory = Path(directory)
+        self.segment_max_bytes = segment_max_bytes
+        self.compression = compression
+        self.format = _SEGMENT_FORMATS[compression]
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.lock = threading.Lock()  # Guards appends and cursor updates within this process
+        self.lock_path = self.directory / QUEUE_LOCK_FILE
+        self.drain_locks = {}  # Per cursor, held by whichever thread of this process is draining it
+        self.drain_files = {}  # Per cursor, the flock()ed file while this process drains it
+        self.cursors = {}
+        self.next_seq = 1
+        with self._locked():
+            self.next_seq = self._recover_next_seq()
+        self.use_cursors(cursors)
+
+    @contextlib.contextmanager
+    def _locked(self):
+        """Exclusive access to the queue files, across threads and triggers."""
+        with self.lock, _file_lock(self.lock_path):
+            yield
+
+    # -- segment bookkeeping -------------------------------------------------
+
+    def _segments(self):
+        """Return (first seq, path, format) for all segments, oldest first."""
+        segments = []
+        for name in os.listdir(self.directory):
+            first, dot, rest = name.partition(".")
+            fmt = _SEGMENT_SUFFIXES.get(dot + rest)
+            if fmt is not None and first.isdigit():
+                segments.append((int(first), self.directory / name, fmt))
+        return sorted(segments, key=lambda segment: segment[0])
+
+    def _recover_next_seq(self, repair=True):
+        segments = self._segments()
+        if segments and repair:
+            segments[-1][2].repair(segments[-1][1])
+        for first_seq, path, fmt in reversed(segments):
+            last = fmt.last_record(path)
+            if last:
+                try:
+                    return fmt.decode(last)["seq"] + 1
+                except (ValueError, KeyError, pa.ArrowException):
+                    pass
+            else:
+                return first_seq
+        # Empty queue: continue after the highest sequence any cursor has committed
+        committed = [self._load_cursor(name)["seq"] for name in self._cursor_names_on_disk()]
+        return max(committed + [self.next_seq - 1]) + 1
+
+    def _cursor_path(self, name):
+        return self.directory / (CURSOR_FILE if name == DEFAULT_CURSOR else f"cursor-{name}.json")
+
+    def _cursor_names_on_disk(self):
+        names = []
+        for file_name in os.listdir(self.directory):
+            if file_name == CURSOR_FILE:
+                names.append(DEFAULT_CURSOR)
+            elif file_name.startswith("cursor-") and file_name.endswith(".json"):
+                names.append(file_name[len("cursor-"):-len(".json")])
+        return names
+
+    def _load_cursor(self, name):
+        path = self._cursor_path(name)
+        if path.exists():
+            with open(path, "r", encoding="utf-8") as f:
+                return json.load(f)
+        return None
+
+    def _store_cursor(self, name):
+        path = self._cursor_path(name)
+        tmp = path.with_suffix(".tmp")
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(self.cursors[name], f)
+        os.replace(tmp, path)
+
+    def _collect_garbage(self):
+        """Delete segments that every cursor in use has moved past."""
+        positions = [cursor["segment"] for cursor in self.cursors.values()]
+        if not positions or None in positions:
+            return
+        oldest = min(positions)
+        for first_seq, path, _ in self._segments():
+            if first_seq < oldest:
+                path.unlink()
+
+    # -- public API ----------------------------------------------------------
+
+    def use_cursors(self, names):
+        """
+        Set the cursors (destinations) that pin segments, creating missing ones at the queue end.
+
+        Cursor files of names not listed are left on disk but no longer hold
+        back segment deletion.
+
+        Args:
+            names (list): Cursor names.
+        """
+        with self._locked():
+            cursors = {}
+            for name in names:
+                cursor = self.cursors.get(name) or self._load_cursor(name)
+                if cursor is None:
+                    segments = self._segments()
+                    cursor = {"seq": self.next_seq - 1, "segment": segments[-1][0] if segments else None, "offset": 0}
+                    self.cursors[name] = cursor
+                    self._store_cursor(name)
+                cursors[name] = cursor
+                self.drain_locks.setdefault(name, threading.Lock())
+            self.cursors = cursors
+
+    def append(self, entries):
+        """
+        Append entries to the active segment, assigning sequence numbers.
+
+        Args:
+            entries (list): Dictionaries with 'table', 'line' and optionally 'checksum',
+                or 'table', 'batch', 'tags' and 'rows' for Arrow batches.
 
+        Returns:
+            int: Number of entries appended.
+        """
+        if not entries:
+            return 0
+        with self._locked():
+            return self._append(entries)
+
+    def _append(self, entries):
+        queued_at = int(time.time())
+        appended = 0
+        # Line entries go to the configured JSONL format, Arrow batches to Arrow IPC segments
+        arrow_format = _ARROW_SEGMENT_FORMATS[self.compression]
+        for is_arrow, group in itertools.groupby(entries, key=lambda entry: "batch" in entry):
+            fmt = arrow_format if is_arrow else self.format
+            segments = self._segments()
+            path = None
+            if segments:
+                _, active_path, active_format = segments[-1]
+                if active_format.suffix == fmt.suffix and active_path.stat().st_size < self.segment_max_bytes:
+                    path = active_path
+            if path is None:
+                path = self.directory / f"{self.next_seq:020d}{fmt.suffix}"
+
+            records = []
+            for entry in group:
+                if is_arrow:
+                    # A batch takes one sequence number per row, so depth() still counts rows
+                    self.next_seq += entry["rows"]
+                    queue_entry = {"seq": self.next_seq - 1, "table": entry["table"], "tags": entry["tags"],
+                                   "rows": entry["rows"], "queued_at": queued_at, "batch": entry["batch"]}
+                else:
+                    # Only store serializable fields (seq, table, line, queued_at, checksum)
+                    queue_entry = {"seq": self.next_seq, "table": entry["table"], "line": entry["line"], "queued_at": queued_at}
+                    if "checksum" in entry:
+                        queue_entry["checksum"] = entry["checksum"]
+                    self.next_seq += 1
+                records.append(fmt.encode(queue_entry))
+            fmt.append(path, records)
+            appended += len(records)
+        return appended
+
+    def read(self, max_entries=None, cursor=DEFAULT_CURSOR):
+        """
+        Read uncommitted entries starting just after a cursor.
+
+        Each returned entry carries a private '_pos' (segment, byte offset)
+        to resume from once it is committed, which commit() stores in the cursor.
+
+        Args:
+            max_entries (int): Optional upper bound on the number of entries returned,
+                counting an Arrow batch as one entry per row.
+            cursor (str): Cursor (destination) name.
+
+        Returns:
+            list: Queue entries in sequence order.
+        """
+        entries = []
+        count = 0
+        position = self.cursors[cursor]
+        start_segment = position["segment"]
+        for first_seq, path, fmt in self._segments():
+            if start_segment is not None and first_seq < start_segment:
+                continue
+            offset = position["offset"] if first_seq == start_segment else 0
+            for record, resume in fmt.iter_records(path, offset):
+                entry = fmt.decode(record)
+                if entry["seq"] <= position["seq"]:
+                    continue
+                entry["_pos"] = (first_seq, resume)
+                entries.append(entry)
+                count += entry.get("rows", 1)
+                if max_entries is not None and count >= max_entries:
+                    return entries
+        return entries
+
+    def commit(self, entry, cursor=DEFAULT_CURSOR):
+        """
+        Mark every entry up to and including `entry` as replicated for a cursor.
+
+        Args:
+            entry (dict): The last successfully replicated entry returned by read().
+            cursor (str): Cursor (destination) name.
+        """
+        segment, offset = entry["_pos"]
+        with self._locked():
+            self.cursors[cursor] = {"seq": entry["seq"], "segment": segment, "offset": offset}
+            self._store_cursor(cursor)
+            self._collect_garbage()
+
+    def refresh(self):
+        """
+        Re-read the cursors and the last sequence number from disk.
+
+        Needed when another trigger (with its own copy of this module) appends
+        to or drains the same queue directory.
+        """
+        with self._locked():
+            for name in list(self.cursors):
+                self.cursors[name] = self._load_cursor(name) or self.cursors[name]
+            self.next_seq = max(self.next_seq, self._recover_next_seq(repair=False))
+
+    def acquire_drain(self, cursor=DEFAULT_CURSOR):
+        """
+        Try to become the only drainer of a cursor, across threads and triggers.
+
+        On success the cursor is reloaded from disk, since another trigger may
+        have advanced it since this process last looked.
+
+        Returns:
+            bool: False if the cursor is already being drained.
+        """
+        drain_lock = self.drain_locks[cursor]
+        if not drain_lock.acquire(blocking=False):
+            return False
+        if fcntl is not None:
+            f = open(self.directory / f"drain-{cursor}.lock", "a")
+            try:
+                fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                f.close()
+                drain_lock.release()
+                return False
+            self.drain_files[cursor] = f
+        with self._locked():
+            self.cursors[cursor] = self._load_cursor(cursor) or self.cursors[cursor]
+        return True
+
+    def release_drain(self, cursor=DEFAULT_CURSOR):
+        """Give up draining a cursor taken with acquire_drain()."""
+        f = self.drain_files.pop(cursor, None)
+        if f is not None:
+            fcntl.flock(f, fcntl.LOCK_UN)
+            f.close()
+        self.drain_locks[cursor].release()
+
+    def depth(self, cursor=DEFAULT_CURSOR):
+        """Return the number of entries appended but not yet committed for a cursor."""
+        return self.next_seq - 1 - self.cursors[cursor]["seq"]
+
+    def pending_bytes(self, cursor=DEFAULT_CURSOR):
+        """Return the on-disk size of the segments not yet behind a cursor."""
+        position = self.cursors[cursor]
+        total = 0
+        for first_seq, path, _ in self._segments():
+            if position["segment"] is not None and first_seq < position["segment"]:
+                continue
+            try:
+                total += path.stat().st_size
+            except FileNotFoundError:
+                continue
+            if first_seq == position["segment"]:
+                total -= position["offset"]
+        return total
+
+    def oldest_queued_at(self, cursor=DEFAULT_CURSOR):
+        """Return the enqueue time (Unix seconds) of a cursor's oldest uncommitted entry, or None."""
+        entries = self.read(max_entries=1, cursor=cursor)
+        return entries[0].get("queued_at") if entries else None
+
+
+def get_queue(directory=QUEUE_DIR, segment_max_bytes=DEFAULT_SEGMENT_MAX_BYTES, compression="none",
+              cursors=(DEFAULT_CURSOR,)):
+    """
+    Return the queue for `directory`, opening it (and migrating the legacy queue file) on first use.
+
+    Args:
+        directory (Path): Directory that holds the queue segments and cursors.
+        segment_max_bytes (int): Size at which the active segment is rolled.
+        compression (str): Format for new segments: none, zlib or gzip.
+        cursors (list): Cursor names, one per replication destination.
 
-def truncate_queue(successful_entries):
-    """Remove successfully replicated entries from the queue."""
-    all_entries = read_queue()
-    remaining_entries = [entry for entry in all_entries if entry not in successful_entries]
-    with open(QUEUE_FILE, "w", encoding="utf-8") as f:
-        for entry in remaining_entries:
-            f.write(json.dumps(entry) + "\n")
+    Returns:
+        SegmentedQueue: The shared queue instance.
+    """
+    key = str(directory)
+    queue = _QUEUES.get(key)
+    if queue is None:
+        queue = SegmentedQueue(directory, segment_max_bytes, compression, cursors)
+        if QUEUE_FILE.exists():
+            with open(QUEUE_FILE, "r", encoding="utf-8") as f:
+                queue.append([json.loads(line) for line in f if line.strip()])
+            QUEUE_FILE.unlink()
+        _QUEUES[key] = queue
+    else:
+        queue.use_cursors(cursors)
+    queue.segment_max_bytes = segment_max_bytes
+    queue.compression = compression
+    queue.format = _SEGMENT_FORMATS[compression]
+    return queue
 
 
-def row_to_line_protocol(table_name, row, logger=None):
+def row_to_line_protocol(table_name, row, logger=None, timestamp=CUSTOM_TIMESTAMP_NS):
     """
     Convert a row dictionary to a line protocol string with a custom timestamp.
 
@@ -66,6 +714,7 @@ def row_to_line_protocol(table_name, row, logger=None):
         table_name (str): Measurement name.
         row (dict): Row data with 'time', tags, and fields.
         logger: Logger object to log issues (e.g., influxdb3_local).
+        timestamp (int): Timestamp to write; None keeps the row's own 'time'.
 
     Returns:
         str: Line protocol string, or None if invalid.
@@ -76,7 +725,8 @@ def row_to_line_protocol(table_name, row, logger=None):
         return None
 
     # Use a custom timestamp instead of the original
-    timestamp = CUSTOM_TIMESTAMP_NS
+    if timestamp is None:
+        timestamp = row.get("time")
 
     # Separate tags and fields
     tags = {k: str(v) for k, v in row.items() if k != "time" and v is not None and not isinstance(v, (int, float, bool))}
@@ -86,20 +736,21 @@ def row_to_line_protocol(table_name, row, logger=None):
     # Format tags
     tag_str = ""
     if tags:
-        tag_pairs = [f"{k}={v}" for k, v in sorted(tags.items())]
+        tag_pairs = [f"{k.translate(_ESCAPE_KEY)}={v.translate(_ESCAPE_KEY)}" for k, v in sorted(tags.items())]
         tag_str = "," + ",".join(tag_pairs)
 
     # Format fields
     field_pairs = []
     for k, v in sorted(fields.items()):
+        key = k.translate(_ESCAPE_KEY)
         if isinstance(v, bool):
-            field_pairs.append(f"{k}={str(v).lower()}")
+            field_pairs.append(f"{key}={str(v).lower()}")
         elif isinstance(v, int):
-            field_pairs.append(f"{k}={v}i")  # Explicitly mark integers
+            field_pairs.append(f"{key}={v}i")  # Explicitly mark integers
         else:
-            field_pairs.append(f"{k}={v}")
+            field_pairs.append(f"{key}={v}")
     for k, v in sorted(string_fields.items()):
-        field_pairs.append(f"{k}=\"{v}\"")
+        field_pairs.append(f"{k.translate(_ESCAPE_KEY)}=\"{v.translate(_ESCAPE_STRING)}\"")
 
     if not field_pairs:
         if logger:
@@ -109,7 +760,1103 @@ def row_to_line_protocol(table_name, row, logger=None):
     field_str = ",".join(field_pairs)
 
     # Construct line protocol with the custom timestamp
-    return f"{table_name}{tag_str} {field_str} {timestamp}"
+    return f"{table_name.translate(_ESCAPE_MEASUREMENT)}{tag_str} {field_str} {timestamp}"
+
+
+def _build_schema(table_name, columns, rows):
+    """
+    Classify a table's columns into tags and typed fields from the first non-null value of each.
+
+    Returns:
+        dict: Encoding plan with the escaped measurement, sorted tag and field columns
+            (with precomputed "key=" prefixes), and whether every column could be classified.
+    """
+    types = {}
+    pending = [c for c in columns if c != "time"]
+    for row in rows:
+        if not pending:
+            break
+        still_pending = []
+        for column in pending:
+            value = row.get(column)
+            if value is None:
+                still_pending.append(column)
+            else:
+                types[column] = type(value)
+        pending = still_pending
+
+    tags = []
+    fields = []
+    for column in sorted(types):
+        column_type = types[column]
+        if column_type in _FIELD_FORMATTERS:
+            fields.append((column, column.translate(_ESCAPE_KEY) + "=", column_type, _FIELD_FORMATTERS[column_type]))
+        else:
+            tags.append((column, "," + column.translate(_ESCAPE_KEY) + "=", column_type, {}))
+    return {
+        "measurement": table_name.translate(_ESCAPE_MEASUREMENT),
+        "width": len(columns),
+        "tags": tags,
+        "fields": fields,
+        "complete": not pending,
+    }
+
+
+def encode_table_batch(table_name, rows, timestamp=CUSTOM_TIMESTAMP_NS, logger=None):
+    """
+    Encode a whole table batch to line protocol in one pass.
+
+    Columns are classified once per table (and cached while the column set is
+    unchanged) instead of once per row. Each row is then emitted by walking
+    the precomputed tag and field plans; escaped tag values are memoized since
+    tag cardinality is usually low (each memo is reset once it reaches
+    TAG_MEMO_MAX_ENTRIES, so high-cardinality tags cannot grow it unbounded). Rows whose shape or value types disagree
+    with the plan are encoded with row_to_line_protocol instead, so the output
+    matches it for every row.
+
+    Args:
+        table_name (str): Measurement name.
+        rows (list): Row dictionaries with 'time', tags, and fields.
+        timestamp (int): Timestamp written on every line; None keeps each row's 'time'.
+        logger: Logger object to log issues (e.g., influxdb3_local).
+
+    Returns:
+        list: Line protocol strings, one per encodable row.
+    """
+    if not rows:
+        return []
+    columns = tuple(rows[0])
+    schema_key = (table_name, columns)
+    schema = _SCHEMAS.get(schema_key)
+    if schema is None:
+        schema = _build_schema(table_name, columns, rows)
+        if schema["complete"]:
+            _SCHEMAS[schema_key] = schema
+
+    measurement = schema["measurement"]
+    width = schema["width"]
+    tag_plan = schema["tags"]
+    field_plan = schema["fields"]
+    fixed_suffix = f" {timestamp}" if timestamp is not None else None
+    lines = []
+    append = lines.append
+    for row in rows:
+        if len(row) != width:
+            line = row_to_line_protocol(table_name, row, logger, timestamp)
+            if line:
+                append(line)
+            continue
+        parts = [measurement]
+        try:
+            for column, prefix, column_type, memo in tag_plan:
+                value = row[column]
+                if value is None:
+                    continue
+                if type(value) is not column_type:
+                    raise TypeError(column)
+                encoded = memo.get(value)
+                if encoded is None:
+                    if len(memo) >= TAG_MEMO_MAX_ENTRIES:
+                        memo.clear()
+                    encoded = memo[value] = prefix + str(value).translate(_ESCAPE_KEY)
+                parts.append(encoded)
+            separator = " "
+            for column, prefix, column_type, formatter in field_plan:
+                value = row[column]
+                if value is None:
+                    continue
+                if type(value) is not column_type:
+                    raise TypeError(column)
+                parts.append(separator)
+                parts.append(prefix)
+                parts.append(formatter(value))
+                separator = ","
+        except (KeyError, TypeError):
+            line = row_to_line_protocol(table_name, row, logger, timestamp)
+            if line:
+                append(line)
+            continue
+        if separator == " ":
+            if logger:
+                logger.info(f"Skipping row in table {table_name}: no fields provided - row: {row}")
+            continue
+        parts.append(fixed_suffix if fixed_suffix is not None else f" {row['time']}")
+        append("".join(parts))
+    return lines
+
+
+def build_arrow_batches(table_name, rows, timestamp=CUSTOM_TIMESTAMP_NS, max_rows=DEFAULT_MAX_LINES_PER_WRITE, logger=None):
+    """
+    Build columnar queue entries (transport=arrow) for a table batch.
+
+    Rows are grouped by their set of non-null columns so every group becomes
+    a null-free pyarrow.Table with a 'time' column (timestamp[ns]); string
+    columns are tags, as in line protocol. Groups are sliced to at most
+    `max_rows` rows, one write request each. Groups Arrow cannot type (mixed
+    value types in a column) fall back to line protocol entries.
+
+    Args:
+        table_name (str): Measurement name.
+        rows (list): Row dictionaries with 'time', tags, and fields.
+        timestamp (int): Timestamp for every row; None keeps each row's 'time'.
+        max_rows (int): Maximum rows per Arrow batch.
+        logger: Logger object to log issues (e.g., influxdb3_local).
+
+    Returns:
+        list: Queue entries with 'table', 'batch', 'tags' and 'rows', or 'table' and 'line'.
+    """
+    groups = defaultdict(list)
+    for row in rows:
+        groups[tuple(sorted(k for k, v in row.items() if k != "time" and v is not None))].append(row)
+
+    entries = []
+    for columns, group in groups.items():
+        tags = [column for column in columns if type(group[0][column]) is str]
+        if len(tags) == len(columns):
+            if logger:
+                logger.info(f"Skipping {len(group)} rows in table {table_name}: no fields provided")
+            continue
+        try:
+            times = [timestamp] * len(group) if timestamp is not None else [row["time"] for row in group]
+            arrays = [pa.array(times, type=pa.timestamp("ns"))]
+            for column in columns:
+                arrays.append(pa.array([row[column] for row in group]))
+            if any(not pa.types.is_string(arrays[i + 1].type) for i, column in enumerate(columns) if column in tags):
+                raise TypeError("tag column holds non-string values")
+        except (pa.ArrowException, TypeError, OverflowError):
+            lines = encode_table_batch(table_name, group, timestamp, logger)
+            entries.extend({"table": table_name, "line": line} for line in lines)
+            continue
+        batch = pa.Table.from_arrays(arrays, names=["time", *columns])
+        for start in range(0, batch.num_rows, max_rows):
+            piece = batch.slice(start, max_rows)
+            entries.append({"table": table_name, "batch": piece, "tags": tags, "rows": piece.num_rows})
+    return entries
+
+
+def get_remote_client(host, token, database):
+    """
+    Return a remote client for the target, reusing the one from earlier flushes.
+
+    The client (and its HTTP connection pool) is kept at module level and only
+    rebuilt when the token changes or after drop_remote_client(), so steady-state
+    flushes skip connection and TLS setup.
+
+    Args:
+        host (str): Remote InfluxDB 3 host URL.
+        token (str): Remote API token.
+        database (str): Remote database/bucket.
+
+    Returns:
+        InfluxDBClient3: Connected client.
+    """
+    key = (host, database)
+    cached = _CLIENTS.get(key)
+    if cached is not None:
+        cached_token, client = cached
+        if cached_token == token:
+            return client
+        drop_remote_client(host, database)
+    client = InfluxDBClient3(
+        host=host,
+        token=token,
+        database=database
+    )
+    _CLIENTS[key] = (token, client)
+    return client
+
+
+def drop_remote_client(host, database):
+    """Close and forget the cached client for a target so the next call reconnects."""
+    cached = _CLIENTS.pop((host, database), None)
+    if cached is not None:
+        try:
+            cached[1].close()
+        except Exception:
+            pass
+
+
+def iter_chunks(entries, max_lines=DEFAULT_MAX_LINES_PER_WRITE, max_bytes=DEFAULT_MAX_BYTES_PER_WRITE):
+    """
+    Split queue entries into write requests bounded by line count and payload size.
+
+    Args:
+        entries (list): Queue entries in sequence order.
+        max_lines (int): Maximum number of lines per chunk.
+        max_bytes (int): Maximum encoded payload size per chunk (a single oversized
+            line still forms its own chunk).
+
+    Yields:
+        list: Consecutive, non-empty slices of `entries`.
+    """
+    chunk = []
+    chunk_bytes = 0
+    for entry in entries:
+        if "batch" in entry:
+            # An Arrow batch was sized when it was queued and is written on its own
+            if chunk:
+                yield chunk
+                chunk = []
+                chunk_bytes = 0
+            yield [entry]
+            continue
+        size = len(entry["line"].encode("utf-8")) + 1  # Line plus newline separator
+        if chunk and (len(chunk) >= max_lines or chunk_bytes + size > max_bytes):
+            yield chunk
+            chunk = []
+            chunk_bytes = 0
+        chunk.append(entry)
+        chunk_bytes += size
+    if chunk:
+        yield chunk
+
+
+def _format_rfc3339(timestamp_ns):
+    """Format an integer nanosecond timestamp as RFC3339 (e.g., '2025-03-31T07:43:45.123456789Z')."""
+    timestamp_sec = timestamp_ns // 1_000_000_000
+    timestamp_ns_remainder = timestamp_ns % 1_000_000_000
+    return time.strftime("%Y-%m-%dT%H:%M:%S", time.gmtime(timestamp_sec)) + f".{timestamp_ns_remainder:09d}Z"
+
+
+def _series_key(line):
+    """Return (measurement+tags, timestamp) identifying the point a line protocol string writes."""
+    return _UNESCAPED_SPACE.split(line, 1)[0], line.rsplit(" ", 1)[-1]
+
+
+def checksum_table(table_name, table):
+    """
+    Compute per-row checksums of a query result, comparable to queued entry checksums.
+
+    Columns are pulled out of the Arrow result once (with 'time' cast to integer
+    nanoseconds) and re-encoded with the batch encoder, so a row matches when it
+    would have produced the exact line protocol that was queued.
+
+    Args:
+        table_name (str): Measurement name.
+        table (pyarrow.Table): Query result.
+
+    Returns:
+        dict: Checksum -> series key for every row in the result.
+    """
+    if table.num_rows == 0:
+        return {}
+    columns = {}
+    for name in table.column_names:
+        column = table.column(name)
+        if name == "time":
+            column = column.cast(pa.int64())
+        columns[name] = column.to_pylist()
+    names = list(columns)
+    rows = [dict(zip(names, values)) for values in zip(*columns.values())]
+    lines = encode_table_batch(table_name, rows, timestamp=None)
+    return {hashlib.md5(line.encode()).hexdigest(): _series_key(line) for line in lines}
+
+
+def _entry_lines(entry):
+    """Return the number of rows a queue entry writes."""
+    return entry["rows"] if "batch" in entry else 1
+
+
+def _entry_bytes(entry):
+    """Return the approximate payload size of a queue entry."""
+    return entry["batch"].nbytes if "batch" in entry else len(entry["line"]) + 1
+
+
+def _arrow_entry_lines(entry):
+    """Re-encode an Arrow batch entry as checksummed line entries for validation."""
+    batch = entry["batch"]
+    columns = {name: (batch.column(name).cast(pa.int64()) if name == "time" else batch.column(name)).to_pylist()
+               for name in batch.column_names}
+    rows = [dict(zip(columns, values)) for values in zip(*columns.values())]
+    return [
+        {"table": entry["table"], "line": line, "checksum": hashlib.md5(line.encode()).hexdigest()}
+        for line in encode_table_batch(entry["table"], rows, timestamp=None)
+    ]
+
+
+def validate_entries(influxdb3_local, client, entries):
+    """
+    Check replicated entries against the remote instance with one query per table.
+
+    For each table in `entries`, the remote rows in the chunk's time range are
+    fetched in a single query and checksummed; the queued checksums are then
+    compared as sets. Entries whose checksum is absent are reported as
+    mismatched when the remote holds a different row for the same series and
+    timestamp, and as missing otherwise.
+
+    Args:
+        influxdb3_local: Local InfluxDB 3 instance for logging.
+        client (InfluxDBClient3): Remote client.
+        entries (list): Replicated queue entries (only Arrow batches and line entries
+            with a 'checksum' are checked).
+
+    Returns:
+        dict: Totals of 'checked', 'missing' and 'mismatched' entries.
+    """
+    by_table = defaultdict(list)
+    for entry in entries:
+        if "batch" in entry:
+            by_table[entry["table"]].extend(_arrow_entry_lines(entry))
+        elif entry.get("checksum"):
+            by_table[entry["table"]].append(entry)
+
+    totals = {"checked": 0, "missing": 0, "mismatched": 0}
+    for table_name, table_entries in by_table.items():
+        timestamps = [int(entry["line"].rsplit(" ", 1)[-1]) for entry in table_entries]
+        start, stop = _format_rfc3339(min(timestamps)), _format_rfc3339(max(timestamps))
+        query = f'SELECT * FROM "{table_name}" WHERE time >= \'{start}\' AND time <= \'{stop}\''
+        try:
+            result = client.query(query, language="sql")
+        except Exception as e:
+            influxdb3_local.error(f"Validation query failed for {table_name}: {str(e)}")
+            continue
+
+        actual = checksum_table(table_name, result)
+        actual_keys = set(actual.values())
+        missing = []
+        mismatched = []
+        for entry in table_entries:
+            if entry["checksum"] in actual:
+                continue
+            if _series_key(entry["line"]) in actual_keys:
+                mismatched.append(entry)
+            else:
+                missing.append(entry)
+
+        totals["checked"] += len(table_entries)
+        totals["missing"] += len(missing)
+        totals["mismatched"] += len(mismatched)
+        if missing or mismatched:
+            influxdb3_local.error(
+                f"Validation failed for {table_name} between {start} and {stop}: "
+                f"{len(missing)} missing, {len(mismatched)} mismatched of {len(table_entries)} rows"
+            )
+    if totals["checked"]:
+        influxdb3_local.info(f"Validated {totals['checked']} replicated entries")
+    return totals
+
+
+class FlowControl:
+    """
+    AIMD (additive-increase, multiplicative-decrease) control of write batch size and request rate.
+
+    While the remote accepts writes, the batch size and the request rate grow
+    by a fixed step per accepted request. A 429, a failed write, or a latency
+    spike (a request taking LATENCY_SPIKE_FACTOR times the moving average)
+    halves both, and a 429's retry-after holds all sends until it expires.
+    Requests are paced with a token bucket refilled at the current rate and
+    holding up to one second of requests, so short bursts go out without
+    waiting. The state is a plain dict kept in the plugin cache, so the limits
+    learned in one invocation carry over to the next.
+    """
+
+    def __init__(self, state, max_lines, min_lines, max_rate):
+        self.max_lines = max_lines
+        self.min_lines = min(min_lines, max_lines)
+        self.max_rate = max_rate
+        self.state = state
+        state.setdefault("batch_lines", max_lines)
+        state.setdefault("rate", max_rate)
+        state.setdefault("latency_ewma", 0.0)
+        state.setdefault("retry_at", 0.0)
+        state.setdefault("tokens", max(1.0, max_rate))
+        state.setdefault("refilled_at", time.time())
+        state.setdefault("throttled", 0)
+        # Respect configuration changes made since the state was stored
+        state["batch_lines"] = max(self.min_lines, min(state["batch_lines"], max_lines))
+        state["rate"] = max(MIN_REQUESTS_PER_SECOND, min(state["rate"], max_rate))
+
+    @classmethod
+    def load(cls, influxdb3_local, key, max_lines, min_lines, max_rate):
+        """Restore controller state from the plugin cache (see store())."""
+        state = influxdb3_local.cache.get(key, default=None) or {}
+        return cls(state, max_lines, min_lines, max_rate)
+
+    def store(self, influxdb3_local, key):
+        influxdb3_local.cache.put(key, self.state)
+
+    @property
+    def batch_lines(self):
+        return int(self.state["batch_lines"])
+
+    def _refill(self):
+        now = time.time()
+        rate = self.state["rate"]
+        elapsed = max(0.0, now - self.state["refilled_at"])
+        self.state["tokens"] = min(max(1.0, rate), self.state["tokens"] + elapsed * rate)
+        self.state["refilled_at"] = now
+        return now
+
+    def wait_time(self):
+        """Seconds until the next request may be sent (retry-after and rate limit)."""
+        now = self._refill()
+        rate_wait = (1.0 - self.state["tokens"]) / self.state["rate"] if self.state["tokens"] < 1.0 else 0.0
+        return max(self.state["retry_at"] - now, rate_wait)
+
+    def on_send(self, requests=1):
+        """Take `requests` tokens from the bucket (it may go negative for a concurrent window)."""
+        self._refill()
+        self.state["tokens"] -= requests
+
+    def on_success(self, latency):
+        ewma = self.state["latency_ewma"]
+        if ewma and latency > ewma * LATENCY_SPIKE_FACTOR:
+            self._decrease()
+        else:
+            self.state["batch_lines"] = min(self.max_lines, self.state["batch_lines"] + max(1, self.max_lines * AIMD_INCREASE_FRACTION))
+            self.state["rate"] = min(self.max_rate, self.state["rate"] + self.max_rate * AIMD_INCREASE_FRACTION)
+        self.state["latency_ewma"] = latency if not ewma else ewma + LATENCY_EWMA_ALPHA * (latency - ewma)
+
+    def on_throttle(self, retry_after):
+        self.state["throttled"] += 1
+        self._decrease()
+        self.state["retry_at"] = time.time() + retry_after
+
+    def on_error(self):
+        self._decrease()
+
+    def _decrease(self):
+        self.state["batch_lines"] = max(self.min_lines, self.state["batch_lines"] * AIMD_DECREASE_FACTOR)
+        self.state["rate"] = max(MIN_REQUESTS_PER_SECOND, self.state["rate"] * AIMD_DECREASE_FACTOR)
+
+
+def send_chunk(client, chunk):
+    """
+    Make a single write request for a chunk of queue entries.
+
+    Line entries are written as line protocol; a chunk holding an Arrow batch
+    is written through the client's DataFrame path.
+
+    Args:
+        client (InfluxDBClient3): Remote client.
+        chunk (list): Queue entries to write (line entries, or a single Arrow batch).
+
+    Returns:
+        tuple: (status, latency seconds, retry-after seconds, error) where status is
+            "ok", "throttled" (HTTP 429) or "failed".
+    """
+    start = time.perf_counter()
+    try:
+        if "batch" in chunk[0]:
+            entry = chunk[0]
+            client.write(
+                record=entry["batch"].to_pandas(),
+                data_frame_measurement_name=entry["table"],
+                data_frame_tag_columns=entry["tags"],
+                data_frame_timestamp_column="time",
+            )
+        else:
+            client.write([entry["line"] for entry in chunk])  # Write as line protocol
+        return "ok", time.perf_counter() - start, 0, None
+    except InfluxDBError as e:
+        if e.response and e.response.status == 429:
+            # Handle 429 Too Many Requests
+            retry_after = int(e.response.headers.get("retry-after", 1))
+            return "throttled", time.perf_counter() - start, retry_after, e
+        return "failed", time.perf_counter() - start, 0, e
+    except Exception as e:
+        return "failed", time.perf_counter() - start, 0, e
+
+
+def new_drain_stats():
+    """Return empty counters filled in by drain_queue() and reported by write_replicator_stats()."""
+    return {
+        "lines_sent": 0,
+        "bytes_sent": 0,
+        "requests": 0,
+        "throttled": 0,
+        "failed": 0,
+        "latencies": [],
+        "validation_missing": 0,
+        "validation_mismatched": 0,
+    }
+
+
+def drain_queue(influxdb3_local, client, queue, flow, max_bytes=DEFAULT_MAX_BYTES_PER_WRITE,
+                concurrency=1, do_validate=False, max_retries=3, blocking=True, stats=None,
+                cursor=DEFAULT_CURSOR):
+    """
+    Replicate queued entries in bounded chunks, committing the cursor after each one.
+
+    Chunk size and pacing come from `flow`. With `concurrency` > 1, up to that
+    many chunks are in flight to the remote at once. Chunks may finish out of
+    order, so the cursor only advances over the contiguous prefix of accepted
+    chunks; anything after a rejected chunk is re-read from the cursor and
+    resent in the (now smaller) batch size.
+
+    Args:
+        influxdb3_local: Local InfluxDB 3 instance for logging.
+        client (InfluxDBClient3): Remote client.
+        queue (SegmentedQueue): Queue to drain.
+        flow (FlowControl): Batch size and rate controller.
+        max_bytes (int): Maximum payload bytes per write request.
+        concurrency (int): Number of write requests kept in flight.
+        do_validate (bool): Validate each accepted chunk against the remote.
+        max_retries (int): Consecutive failed requests tolerated before giving up; 429s
+            only shrink the batch and wait out retry-after, and never count.
+        blocking (bool): Sleep for rate limits and backoff; when False, stop
+            draining instead and leave the rest queued.
+        stats (dict): Optional counters from new_drain_stats() to accumulate into.
+        cursor (str): Queue cursor of the destination `client` writes to.
+
+    Returns:
+        bool: False if the drain gave up after failed writes.
+    """
+    if stats is None:
+        stats = new_drain_stats()
+    if not queue.acquire_drain(cursor):
+        influxdb3_local.info(f"Queue is already being drained to {cursor} by another trigger")
+        return True
+    replicated = 0
+    failures = 0
+    executor = ThreadPoolExecutor(max_workers=concurrency) if concurrency > 1 else None
+    try:
+        while True:
+            wait = flow.wait_time()
+            if wait > 0:
+                if not blocking:
+                    influxdb3_local.info(f"Write rate limited; leaving remaining lines queued for {wait:.1f} seconds")
+                    break
+                time.sleep(wait)
+
+            entries = queue.read(max_entries=flow.batch_lines * max(concurrency, 1), cursor=cursor)
+            if not entries:
+                break
+            chunks = list(iter_chunks(entries, flow.batch_lines, max_bytes))
+            if executor:
+                flow.on_send(len(chunks))
+                results = list(executor.map(lambda chunk: send_chunk(client, chunk), chunks))
+            else:
+                # Send one chunk per pass so each request is paced by the controller
+                chunks = chunks[:1]
+                flow.on_send()
+                results = [send_chunk(client, chunks[0])]
+
+            for chunk, (status, latency, retry_after, error) in zip(chunks, results):
+                stats["requests"] += 1
+                stats["latencies"].append(latency)
+                if status == "ok":
+                    flow.on_success(latency)
+                    if do_validate:
+                        totals = validate_entries(influxdb3_local, client, chunk)
+                        stats["validation_missing"] += totals["missing"]
+                        stats["validation_mismatched"] += totals["mismatched"]
+                    queue.commit(chunk[-1], cursor=cursor)
+                    lines = sum(_entry_lines(entry) for entry in chunk)
+                    replicated += lines
+                    stats["lines_sent"] += lines
+                    stats["bytes_sent"] += sum(_entry_bytes(entry) for entry in chunk)
+                    failures = 0
+                    continue
+
+                if status == "throttled":
+                    # Not a failure: shrink the batch, hold sends until retry-after, then resend from the cursor
+                    stats["throttled"] += 1
+                    flow.on_throttle(retry_after)
+                    influxdb3_local.info(
+                        f"Rate limit hit (429), retrying after {retry_after} seconds "
+                        f"with batches of {flow.batch_lines} lines"
+                    )
+                    break
+
+                failures += 1
+                stats["failed"] += 1
+                flow.on_error()
+                influxdb3_local.error(f"Replication attempt {failures} failed: {str(error)}")
+                flow.state["retry_at"] = max(flow.state["retry_at"], time.time() + 2 ** (failures - 1))
+                if failures >= max_retries or not blocking:
+                    if failures >= max_retries > 1:
+                        influxdb3_local.error("Max retries reached; data remains in queue")
+                    return False
+                break
+    finally:
+        if executor:
+            executor.shutdown(wait=True)
+        queue.release_drain(cursor)
+        if replicated:
+            influxdb3_local.info(f"Replicated {replicated} lines to {cursor}")
+    return True
+
+
+def _percentile(sorted_values, percentile):
+    """Nearest-rank percentile of an already sorted list."""
+    index = int(len(sorted_values) * (percentile / 100))
+    return sorted_values[min(index, len(sorted_values) - 1)]
+
+
+def write_replicator_stats(influxdb3_local, queue, trigger, stats, encode_seconds=None, queued_lines=0,
+                           destination=DEFAULT_CURSOR):
+    """
+    Write one STATS_MEASUREMENT point describing this invocation and one destination's backlog.
+
+    Fields cover the backlog (queue_lines, queue_bytes, lag_seconds since the
+    oldest queued entry was enqueued), what was sent (lines_sent, bytes_sent,
+    requests, throttled, failed), write latency percentiles in milliseconds,
+    validation results, and on WAL flushes the rows queued and encode time.
+
+    Args:
+        influxdb3_local: Local InfluxDB 3 instance to write to.
+        queue (SegmentedQueue): Replication queue.
+        trigger (str): "wal" or "schedule", written as a tag.
+        stats (dict): Counters from new_drain_stats().
+        encode_seconds (float): Time spent filtering and encoding the WAL flush.
+        queued_lines (int): Lines appended to the queue by this flush.
+        destination (str): Destination (queue cursor) name, written as a tag.
+    """
+    queue.refresh()
+    oldest = queue.oldest_queued_at(destination)
+    line = LineBuilder(STATS_MEASUREMENT)\
+        .tag("trigger", trigger)\
+        .tag("destination", destination)\
+        .int64_field("queue_lines", queue.depth(destination))\
+        .int64_field("queue_bytes", queue.pending_bytes(destination))\
+        .float64_field("lag_seconds", max(0.0, time.time() - oldest) if oldest else 0.0)\
+        .int64_field("queued_lines", queued_lines)\
+        .int64_field("lines_sent", stats["lines_sent"])\
+        .int64_field("bytes_sent", stats["bytes_sent"])\
+        .int64_field("requests", stats["requests"])\
+        .int64_field("throttled", stats["throttled"])\
+        .int64_field("failed", stats["failed"])\
+        .int64_field("validation_missing", stats["validation_missing"])\
+        .int64_field("validation_mismatched", stats["validation_mismatched"])
+    if oldest:
+        line.int64_field("oldest_queued_at", oldest)
+    if stats["latencies"]:
+        latencies = sorted(stats["latencies"])
+        line.float64_field("write_latency_p50_ms", _percentile(latencies, 50) * 1000)\
+            .float64_field("write_latency_p95_ms", _percentile(latencies, 95) * 1000)\
+            .float64_field("write_latency_p99_ms", _percentile(latencies, 99) * 1000)\
+            .float64_field("write_latency_max_ms", latencies[-1] * 1000)
+    if encode_seconds is not None:
+        line.float64_field("encode_ms", encode_seconds * 1000)
+    influxdb3_local.write(line)
+
+
+def _compile_predicate(column, op, literal):
+    """Build a fast row -> bool matcher for one predicate; missing (None) values never match."""
+    if op in _NUMERIC_OPS:
+        compare = _NUMERIC_OPS[op]
+        threshold = float(literal)
+
+        def predicate(row):
+            value = row.get(column)
+            return type(value) in (int, float) and compare(value, threshold)
+        return predicate
+
+    if op in ("=~", "!~"):
+        search = re.compile(literal).search
+        expected = op == "=~"
+
+        def predicate(row):
+            value = row.get(column)
+            return value is not None and (search(value if type(value) is str else str(value)) is not None) == expected
+        return predicate
+
+    literals = literal.split("|") if op in ("in", "not in") else [literal]
+    strings = frozenset(literals)
+    numbers = set()
+    for item in literals:
+        try:
+            numbers.add(float(item))
+        except ValueError:
+            pass
+    numbers = frozenset(numbers)
+    expected = op in ("==", "in")
+
+    def predicate(row):
+        value = row.get(column)
+        if value is None:
+            return False
+        if type(value) is str:
+            return (value in strings) == expected
+        return (value in numbers or str(value) in strings) == expected
+    return predicate
+
+
+def compile_filters(tables_arg, filters_arg):
+    """
+    Compile the 'tables' and 'filters' arguments once and cache the result.
+
+    'filters' is a ';'-separated list of predicates of the form
+    '<table>.<column><op><value>' with op one of ==, !=, =~ (regex search),
+    !~, >, >=, <, <=, or '<table>.<column> in a|b|c' / 'not in a|b|c' for set
+    membership. Predicates on the same table are AND-ed, and table '*' applies
+    to every table. Numeric comparisons only match int/float values; a
+    missing value never matches.
+
+    Args:
+        tables_arg (str): Comma-separated table names, or None for all tables.
+        filters_arg (str): Filter expression, or 'none' to disable filtering.
+
+    Returns:
+        tuple: (set of table names or None, dict of table name -> matcher(row) -> bool).
+    """
+    key = (tables_arg, filters_arg)
+    compiled = _FILTERS.get(key)
+    if compiled is not None:
+        return compiled
+
+    tables = {t.strip() for t in tables_arg.split(",") if t.strip()} if tables_arg else None
+    predicates = defaultdict(list)
+    if filters_arg and filters_arg.strip().lower() != "none":
+        for expression in filters_arg.split(";"):
+            if not expression.strip():
+                continue
+            match = _PREDICATE.match(expression)
+            if not match:
+                raise ValueError(f"Invalid filter expression: {expression.strip()!r}")
+            table, column, op, literal = match.groups()
+            predicates[table].append(_compile_predicate(column, " ".join(op.split()), literal))
+
+    matchers = {}
+    for table, preds in predicates.items():
+        if len(preds) == 1:
+            matchers[table] = preds[0]
+        else:
+            matchers[table] = lambda row, preds=tuple(preds): all(p(row) for p in preds)
+    if "*" in matchers:
+        any_table = matchers.pop("*")
+        for table, matcher in list(matchers.items()):
+            matchers[table] = lambda row, a=any_table, m=matcher: a(row) and m(row)
+        matchers["*"] = any_table
+
+    compiled = (tables, matchers)
+    _FILTERS[key] = compiled
+    return compiled
+
+
+def parse_duration(text):
+    """
+    Parse a duration such as '500ms', '30s', '1m', '2h' or '1d' into nanoseconds.
+
+    Args:
+        text (str): Integer followed by a unit (ns, us, ms, s, m, h, d).
+
+    Returns:
+        int: Duration in nanoseconds.
+    """
+    match = _DURATION.fullmatch(text.strip())
+    if not match:
+        raise ValueError(f"Invalid duration: {text!r}")
+    return int(match.group(1)) * _DURATION_UNITS[match.group(2)]
+
+
+def get_downsample_state(influxdb3_local, interval_ns, functions):
+    """
+    Load the downsampler state from the plugin cache, starting afresh if the configuration changed.
+
+    The state holds the open buckets keyed by (table, tag set, bucket start),
+    the highest event time seen so far and the resulting watermark. When
+    aggregate_interval or aggregate_functions changed, the buckets still open
+    under the previous settings are emitted as they stand rather than dropped.
+
+    Returns:
+        tuple: (state, emitted) where `emitted` holds the (table name, row dict)
+            pairs flushed from the previous configuration, as from emit_closed_buckets().
+    """
+    config = (interval_ns, tuple(functions))
+    state = influxdb3_local.cache.get(DOWNSAMPLE_STATE_KEY, default=None)
+    emitted = []
+    if state and state.get("config") != config:
+        emitted = _emit_buckets(state["buckets"], sorted(state["buckets"]), state["config"][1])
+        influxdb3_local.info(
+            f"Downsampling configuration changed; emitted {len(emitted)} open buckets under the previous settings"
+        )
+        state = None
+    if not state:
+        state = {"config": config, "buckets": {}, "max_time": 0, "watermark": 0, "late_rows": 0}
+    return state, emitted
+
+
+def downsample_rows(state, table_name, rows, interval_ns):
+    """
+    Fold rows into their open buckets.
+
+    Rows are grouped by their full tag set and the bucket their timestamp falls
+    in. Each numeric field keeps count, sum, min, max and last value, which is
+    enough to emit any supported aggregate. Rows for buckets that were already
+    emitted (behind the watermark) are counted in state['late_rows'] and dropped.
+
+    Args:
+        state (dict): Downsampler state from get_downsample_state().
+        table_name (str): Measurement name.
+        rows (list): Row dictionaries with 'time', tags, and fields.
+        interval_ns (int): Bucket width in nanoseconds.
+    """
+    buckets = state["buckets"]
+    watermark = state["watermark"]
+    max_time = state["max_time"]
+    for row in rows:
+        timestamp = row.get("time")
+        if not timestamp:
+            continue
+        bucket_ts = timestamp - timestamp % interval_ns
+        if bucket_ts + interval_ns <= watermark:
+            state["late_rows"] += 1
+            continue
+        if timestamp > max_time:
+            max_time = timestamp
+
+        tags = []
+        fields = []
+        for k, v in row.items():
+            if k == "time" or v is None:
+                continue
+            if isinstance(v, (int, float)) and not isinstance(v, bool):
+                fields.append((k, v))
+            elif not isinstance(v, bool):
+                tags.append((k, str(v)))
+        tags.sort()
+
+        key = (table_name, tuple(tags), bucket_ts)
+        bucket = buckets.get(key)
+        if bucket is None:
+            bucket = buckets[key] = {}
+        for field, value in fields:
+            stats = bucket.get(field)
+            if stats is None:
+                # [count, sum, min, max, last, last_time]
+                bucket[field] = [1, value, value, value, value, timestamp]
+                continue
+            stats[0] += 1
+            stats[1] += value
+            if value < stats[2]:
+                stats[2] = value
+            if value > stats[3]:
+                stats[3] = value
+            if timestamp >= stats[5]:
+                stats[4] = value
+                stats[5] = timestamp
+    state["max_time"] = max_time
+
+
+def emit_closed_buckets(state, lateness_ns, functions):
+    """
+    Advance the watermark and pop every bucket that ends at or before it.
+
+    The watermark trails the highest event time seen by `lateness_ns`, so
+    buckets stay open long enough for rows arriving in later WAL flushes.
+
+    Args:
+        state (dict): Downsampler state from get_downsample_state().
+        lateness_ns (int): How far the watermark trails the newest event time.
+        functions (list): Aggregates to emit per field (avg, min, max, sum, count, last).
+
+    Returns:
+        list: (table name, row dict) pairs with 'time' set to the bucket start,
+            the bucket's tags and '<function>_<field>' fields, oldest first.
+    """
+    interval_ns = state["config"][0]
+    watermark = max(state["watermark"], state["max_time"] - lateness_ns)
+    state["watermark"] = watermark
+
+    buckets = state["buckets"]
+    return _emit_buckets(buckets, sorted(key for key in buckets if key[2] + interval_ns <= watermark), functions)
+
+
+def _emit_buckets(buckets, keys, functions):
+    """Pop the buckets at `keys` (in order) and return them as (table name, row dict) pairs."""
+    emitted = []
+    for key in keys:
+        table_name, tags, bucket_ts = key
+        row = {"time": bucket_ts, **dict(tags)}
+        for field, stats in sorted(buckets.pop(key).items()):
+            for function in functions:
+                row[f"{function}_{field}"] = _AGGREGATES[function](stats)
+        emitted.append((table_name, row))
+    return emitted
+
+
+def parse_destinations(args):
+    """
+    Read the replication destinations from the trigger arguments.
+
+    host/token/database describe the default destination. 'destinations'
+    names further destinations (separated by ';', '|' or spaces), each
+    configured with '<name>_host', '<name>_token' and '<name>_database'.
+
+    Args:
+        args: Runtime arguments.
+
+    Returns:
+        list: Dicts with name, host, token and database, default destination first.
+
+    Raises:
+        ValueError: If a destination is incompletely configured or none is given.
+    """
+    destinations = []
+    if all(key in args for key in ("host", "token", "database")):
+        destinations.append({"name": DEFAULT_CURSOR, "host": args["host"], "token": args["token"], "database": args["database"]})
+    for name in re.split(r"[;|\s]+", args.get("destinations", "").strip()):
+        if not name:
+            continue
+        if not re.fullmatch(r"\w+", name) or name == DEFAULT_CURSOR:
+            raise ValueError(f"Invalid destination name: {name}")
+        missing = [f"{name}_{key}" for key in ("host", "token", "database") if f"{name}_{key}" not in args]
+        if missing:
+            raise ValueError(f"Missing arguments for destination {name}: {', '.join(missing)}")
+        destinations.append({"name": name, "host": args[f"{name}_host"], "token": args[f"{name}_token"], "database": args[f"{name}_database"]})
+    if not destinations:
+        raise ValueError("Missing required arguments: host, token, or database")
+    return destinations
+
+
+def parse_remote_args(influxdb3_local, args):
+    """
+    Read the remote targets and queue/drain settings shared by both trigger types.
+
+    Args:
+        influxdb3_local: Local InfluxDB 3 instance for logging.
+        args: Runtime arguments.
+
+    Returns:
+        dict: Parsed settings, or None if required arguments are missing or invalid.
+    """
+    try:
+        destinations = parse_destinations(args or {})
+    except ValueError as e:
+        influxdb3_local.error(str(e))
+        return None
+    compression = args.get("queue_compression", "none").lower()
+    if compression not in _SEGMENT_FORMATS:
+        influxdb3_local.error(f"Unsupported queue_compression: {compression} (use none, zlib or gzip)")
+        return None
+    transport = args.get("transport", "line").lower()
+    if transport not in ("line", "arrow"):
+        influxdb3_local.error(f"Unsupported transport: {transport} (use line or arrow)")
+        return None
+    # Numeric settings must all be positive; a bad value rejects the whole configuration
+    numbers = {}
+    for key, name, parse, default in (
+        ("segment_max_bytes", "queue_segment_bytes", int, DEFAULT_SEGMENT_MAX_BYTES),
+        ("max_lines", "max_lines_per_write", int, DEFAULT_MAX_LINES_PER_WRITE),
+        ("max_bytes", "max_bytes_per_write", int, DEFAULT_MAX_BYTES_PER_WRITE),
+        ("write_concurrency", "write_concurrency", int, 1),
+        ("min_lines", "min_lines_per_write", int, DEFAULT_MIN_LINES_PER_WRITE),
+        ("max_rate", "max_requests_per_second", float, DEFAULT_MAX_REQUESTS_PER_SECOND),
+        ("max_retries", "max_retries", int, 3),
+    ):
+        try:
+            value = parse(args.get(name, default))
+        except ValueError:
+            value = None
+        if value is None or value <= 0:
+            kind = "integer" if parse is int else "number"
+            influxdb3_local.error(f"{name} must be a positive {kind}, got {args.get(name)}")
+            return None
+        numbers[key] = value
+    return {
+        "destinations": destinations,
+        "do_validate": args.get("validate", "false").lower() == "true",
+        "compression": compression,
+        "transport": transport,
+        "drain_mode": args.get("drain_mode", "inline").lower(),
+        "self_metrics": args.get("self_metrics", "true").lower() == "true",
+        **numbers,
+    }
+
+
+def open_queue(config):
+    """Return the replication queue with one cursor per configured destination."""
+    return get_queue(QUEUE_DIR, config["segment_max_bytes"], config["compression"],
+                     [destination["name"] for destination in config["destinations"]])
+
+
+def destination_key(key, destination):
+    """Cache key of per-destination state; the default destination keeps the plain key."""
+    return key if destination["name"] == DEFAULT_CURSOR else f"{key}:{destination['name']}"
+
+
+def for_each_destination(config, fn):
+    """
+    Call fn(destination) for every destination and return the results in order.
+
+    With several destinations each runs on its own thread, so a slow or
+    throttled destination (including its backoff sleeps) never holds back
+    the others.
+    """
+    destinations = config["destinations"]
+    if len(destinations) == 1:
+        return [fn(destinations[0])]
+    with ThreadPoolExecutor(max_workers=len(destinations)) as executor:
+        return list(executor.map(fn, destinations))
+
+
+def replicate_queue(influxdb3_local, config, destination, max_retries, blocking, stats=None):
+    """
+    Drain the queue to one destination from `config`, from that destination's own cursor.
+
+    Args:
+        influxdb3_local: Local InfluxDB 3 instance for logging and caching.
+        config (dict): Settings from parse_remote_args().
+        destination (dict): One of config["destinations"].
+        max_retries (int): Consecutive failed requests tolerated before giving up; 429s
+            only shrink the batch and wait out retry-after, and never count.
+        blocking (bool): Whether the drain may sleep for rate limits and backoff.
+        stats (dict): Optional counters from new_drain_stats() to accumulate into.
+
+    Returns:
+        bool: False if the drain gave up after failed writes.
+    """
+    try:
+        client = get_remote_client(destination["host"], destination["token"], destination["database"])
+    except Exception as e:
+        influxdb3_local.error(f"Failed to initialize remote client for {destination['name']}: {str(e)}")
+        return False
+
+    queue = open_queue(config)
+    flow_key = destination_key(FLOW_STATE_KEY, destination)
+    flow = FlowControl.load(influxdb3_local, flow_key, config["max_lines"], config["min_lines"], config["max_rate"])
+    try:
+        completed = drain_queue(
+            influxdb3_local, client, queue, flow,
+            max_bytes=config["max_bytes"], concurrency=config["write_concurrency"],
+            do_validate=config["do_validate"], max_retries=max_retries, blocking=blocking,
+            stats=stats, cursor=destination["name"],
+        )
+    finally:
+        flow.store(influxdb3_local, flow_key)
+    if not completed:
+        # Reconnect on the next drain in case the connection itself went bad
+        drop_remote_client(destination["host"], destination["database"])
+    return completed
+
+
+def drain_with_backoff(influxdb3_local, config, destination, max_retries, blocking, stats):
+    """
+    Drain one destination unless its cross-call backoff is active.
+
+    The backoff is kept in the cache per destination and shared by WAL flushes
+    and scheduled calls: each failed drain doubles it, capped at
+    MAX_DRAIN_BACKOFF_SECONDS, and a completed drain clears it.
+
+    Args:
+        influxdb3_local: Local InfluxDB 3 instance for logging and caching.
+        config (dict): Settings from parse_remote_args().
+        destination (dict): One of config["destinations"].
+        max_retries (int): Passed to replicate_queue().
+        blocking (bool): Passed to replicate_queue().
+        stats (dict): Counters from new_drain_stats() to accumulate into.
+    """
+    backoff_key = destination_key(DRAIN_BACKOFF_KEY, destination)
+    backoff = influxdb3_local.cache.get(backoff_key, default=None) or {"failures": 0, "retry_at": 0}
+    now = time.time()
+    if now < backoff["retry_at"]:
+        influxdb3_local.info(
+            f"Backoff active for {destination['name']}; next drain attempt in {backoff['retry_at'] - now:.0f} seconds"
+        )
+        return
+
+    if replicate_queue(influxdb3_local, config, destination, max_retries=max_retries, blocking=blocking, stats=stats):
+        backoff = {"failures": 0, "retry_at": 0}
+    else:
+        failures = backoff["failures"] + 1
+        delay = min(2 ** failures, MAX_DRAIN_BACKOFF_SECONDS)
+        backoff = {"failures": failures, "retry_at": time.time() + delay}
+        influxdb3_local.info(
+            f"Drain to {destination['name']} failed {failures} time(s) in a row; backing off {delay} seconds"
+        )
+    influxdb3_local.cache.put(backoff_key, backoff)
 
 
 def process_writes(influxdb3_local, table_batches, args=None):
@@ -117,163 +1864,171 @@ def process_writes(influxdb3_local, table_batches, args=None):
     Replicate any data written to InfluxDB v3 Core to a remote InfluxDB 3 instance on WAL flush,
     with validation, downsampling, and table filtering.
 
+    Rows are encoded once and appended to the local queue, which every
+    destination drains from its own cursor. With drain_mode=inline
+    (the default) the queue is then drained without ever sleeping: a failed
+    chunk, a 429 or the adaptive rate limit simply end the drain, so a
+    struggling remote never stalls the WAL trigger and anything left is
+    retried on a later flush. A destination whose drain failed is skipped
+    by the following flushes for a growing backoff (see drain_with_backoff),
+    so a slow or failing remote costs at most one request now and then.
+    With drain_mode=scheduled the
+    queue is drained only by process_scheduled_call.
+
     Args:
         influxdb3_local: Local InfluxDB 3 instance for logging and caching.
         table_batches: List of dictionaries containing table data from WAL flush.
-        args: Runtime arguments (host, token, database, tables, aggregate_interval, validate).
+        args: Runtime arguments (host, token, database, destinations, tables, aggregate_interval,
+            filters, aggregate_functions, aggregate_lateness, validate, drain_mode, self_metrics,
+            queue_segment_bytes, queue_compression, transport, max_lines_per_write, min_lines_per_write,
+            max_bytes_per_write, max_requests_per_second, write_concurrency).
     """
-    influxdb3_local.info(f"Starting generic data replication process with line protocol, PLUGIN_DIR={PLUGIN_DIR}")
+    influxdb3_local.info(f"Starting generic data replication process, PLUGIN_DIR={PLUGIN_DIR}")
 
-    if not args or "host" not in args or "token" not in args or "database" not in args:
-        influxdb3_local.error("Missing required arguments: host, token, or database")
+    config = parse_remote_args(influxdb3_local, args)
+    if config is None:
         return
 
-    remote_host = args["host"]
-    remote_token = args["token"]
-    remote_db = args["database"]
-
-    tables_to_replicate = args.get("tables", "").split(",") if args.get("tables") else None
+    try:
+        tables_to_replicate, row_filters = compile_filters(args.get("tables"), args.get("filters", DEFAULT_FILTERS))
+    except (ValueError, re.error) as e:
+        influxdb3_local.error(f"Invalid filters: {str(e)}")
+        return
     aggregate_interval = args.get("aggregate_interval")
-    do_validate = args.get("validate", "false").lower() == "true"
+    do_validate = config["do_validate"]
+
+    if aggregate_interval:
+        try:
+            interval_ns = parse_duration(aggregate_interval)
+            lateness_ns = parse_duration(args.get("aggregate_lateness", "0s"))
+            aggregate_functions = args.get("aggregate_functions", "avg").split()
+            unknown = [f for f in aggregate_functions if f not in _AGGREGATES]
+            if unknown:
+                raise ValueError(f"Unsupported aggregate functions: {', '.join(unknown)}")
+        except ValueError as e:
+            influxdb3_local.error(f"Invalid downsampling configuration: {str(e)}")
+            return
 
     # Log the validation setting for debugging
     influxdb3_local.info(f"Validation enabled: {do_validate}")
 
-    try:
-        client = InfluxDBClient3(
-            host=remote_host,
-            token=remote_token,
-            database=remote_db
-        )
-    except Exception as e:
-        influxdb3_local.error(f"Failed to initialize remote client: {str(e)}")
-        return
-
+    encode_start = time.perf_counter()
     lines_to_replicate = []
     latest_timestamp = influxdb3_local.cache.get(STATE_KEY, default=0)
-
     if aggregate_interval:  # Only downsample if aggregate_interval is explicitly set
-        interval_sec = 60 if aggregate_interval == "1m" else int(aggregate_interval[:-1])
-        aggregates = defaultdict(lambda: {"count": 0, "sum": {}, "tags": {}})
-
+        state, emitted = get_downsample_state(influxdb3_local, interval_ns, aggregate_functions)
         for table_batch in table_batches:
             table_name = table_batch["table_name"]
+            if table_name == STATS_MEASUREMENT:
+                continue  # Never replicate our own metrics
             if tables_to_replicate and table_name not in tables_to_replicate:
                 continue
 
-            for row in table_batch["rows"]:
-                timestamp = row.get("time")
-                if not timestamp or timestamp <= latest_timestamp:
-                    continue
-
-                # Filter for cpu = 'cpu-total'
-                if table_name == "cpu" and row.get("cpu") != "cpu-total":
-                    continue
+            rows = table_batch["rows"]
+            matcher = row_filters.get(table_name) or row_filters.get("*")
+            if matcher:
+                rows = [row for row in rows if matcher(row)]
+            downsample_rows(state, table_name, rows, interval_ns)
 
-                bucket_ts = timestamp // (interval_sec * 10**9) * (interval_sec * 10**9)
-                key = (table_name, bucket_ts)
-
-                aggregates[key]["count"] += 1
-                tags = {k: str(v) for k, v in row.items() if k != "time" and v is not None and not isinstance(v, (int, float, bool))}
-                fields = {k: v for k, v in row.items() if k != "time" and v is not None and isinstance(v, (int, float))}
-                aggregates[key]["tags"] = tags
-                for field, value in fields.items():
-                    aggregates[key]["sum"][field] = aggregates[key]["sum"].get(field, 0) + value
-
-        for (table_name, timestamp), data in aggregates.items():
-            avg_fields = {f"avg_{field}": total / data["count"] for field, total in data["sum"].items()}
-            aggregated_row = {"time": timestamp, **data["tags"], **avg_fields}
-            line = row_to_line_protocol(table_name, aggregated_row, influxdb3_local)
-            if line:
-                lines_to_replicate.append({"table": table_name, "line": line})
-                latest_timestamp = max(latest_timestamp, timestamp)
+        emitted += emit_closed_buckets(state, lateness_ns, aggregate_functions)
+        if config["transport"] == "arrow":
+            for table_name, table_rows in itertools.groupby(emitted, key=lambda item: item[0]):
+                lines_to_replicate.extend(build_arrow_batches(
+                    table_name, [row for _, row in table_rows], None, config["max_lines"], influxdb3_local))
+        else:
+            for table_name, aggregated_row in emitted:
+                line = row_to_line_protocol(table_name, aggregated_row, influxdb3_local, timestamp=None)
+                if line:
+                    lines_to_replicate.append({"table": table_name, "line": line})
+        late_rows, state["late_rows"] = state["late_rows"], 0
+        influxdb3_local.cache.put(DOWNSAMPLE_STATE_KEY, state)
+        if late_rows:
+            influxdb3_local.info(f"Dropped {late_rows} rows behind the downsampling watermark")
     else:
         for table_batch in table_batches:
             table_name = table_batch["table_name"]
+            if table_name == STATS_MEASUREMENT:
+                continue  # Never replicate our own metrics
             if tables_to_replicate and table_name not in tables_to_replicate:
                 continue
 
-            for row in table_batch["rows"]:
-                timestamp = row.get("time")
-                if not timestamp or timestamp <= latest_timestamp:
-                    continue
-
-                # Filter for cpu = 'cpu-total'
-                if table_name == "cpu" and row.get("cpu") != "cpu-total":
-                    continue
+            # Apply the time cut-off and row filters before any encoding
+            matcher = row_filters.get(table_name) or row_filters.get("*")
+            if matcher:
+                rows = [row for row in table_batch["rows"] if (row.get("time") or 0) > latest_timestamp and matcher(row)]
+            else:
+                rows = [row for row in table_batch["rows"] if (row.get("time") or 0) > latest_timestamp]
 
-                # Override the timestamp in the row for local write
-                row["time"] = CUSTOM_TIMESTAMP_NS
-                line = row_to_line_protocol(table_name, row, influxdb3_local)
-                if line:
-                    lines_to_replicate.append({"table": table_name, "line": line})
-                    latest_timestamp = max(latest_timestamp, CUSTOM_TIMESTAMP_NS)
+            # Encode the whole batch (as line protocol or Arrow batches) with the custom timestamp
+            if config["transport"] == "arrow":
+                entries = build_arrow_batches(table_name, rows, CUSTOM_TIMESTAMP_NS, config["max_lines"], influxdb3_local)
+            else:
+                entries = [{"table": table_name, "line": line}
+                           for line in encode_table_batch(table_name, rows, CUSTOM_TIMESTAMP_NS, influxdb3_local)]
+            if entries:
+                lines_to_replicate.extend(entries)
+                latest_timestamp = max(latest_timestamp, CUSTOM_TIMESTAMP_NS)
 
+    queue = open_queue(config)
+    queued_lines = sum(_entry_lines(entry) for entry in lines_to_replicate)
     if lines_to_replicate:
         if do_validate:
             for entry in lines_to_replicate:
-                entry["checksum"] = hashlib.md5(entry["line"].encode()).hexdigest()
-        append_to_queue(lines_to_replicate)
-        influxdb3_local.info(f"Queued {len(lines_to_replicate)} lines from {', '.join(set(p['table'] for p in lines_to_replicate))}")
+                if "line" in entry:
+                    entry["checksum"] = hashlib.md5(entry["line"].encode()).hexdigest()
+        encode_seconds = time.perf_counter() - encode_start
+        queue.append(lines_to_replicate)
+        influxdb3_local.cache.put(STATE_KEY, latest_timestamp)
+        influxdb3_local.info(f"Queued {queued_lines} lines from {', '.join(set(p['table'] for p in lines_to_replicate))}")
+
+    else:
+        encode_seconds = time.perf_counter() - encode_start
+
+    def drain(destination):
+        stats = new_drain_stats()
+        if config["drain_mode"] == "inline":
+            drain_with_backoff(influxdb3_local, config, destination, max_retries=1, blocking=False, stats=stats)
+        return stats
+
+    # A flush holding nothing but our own metrics must not write more of them, or every
+    # replicator_stats point would trigger the next flush (and point) forever
+    own_metrics_only = all(table_batch["table_name"] == STATS_MEASUREMENT for table_batch in table_batches)
+    for destination, stats in zip(config["destinations"], for_each_destination(config, drain)):
+        if config["self_metrics"] and not own_metrics_only:
+            write_replicator_stats(influxdb3_local, queue, "wal", stats, encode_seconds, queued_lines,
+                                   destination["name"])
+
+
+def process_scheduled_call(influxdb3_local, call_time, args=None):
+    """
+    Drain the replication queue on a schedule, owning retries and backoff.
 
-    queued_entries = read_queue()
-    if not queued_entries:
-        influxdb3_local.info("No data to replicate")
+    Pair this with a WAL trigger using drain_mode=scheduled so that remote
+    slowness, 429s and outages only ever delay this trigger. Each destination
+    is drained independently: chunks are retried with exponential backoff and
+    paced by that destination's adaptive flow control (see FlowControl)
+    within a call; when a call still fails, further calls for that
+    destination are skipped until a cross-call backoff (doubling per
+    consecutive failure, capped at MAX_DRAIN_BACKOFF_SECONDS) has elapsed.
+
+    Args:
+        influxdb3_local: Local InfluxDB 3 instance for logging and caching.
+        call_time: Time of the scheduled call.
+        args: Runtime arguments (host, token, database, destinations, validate, self_metrics, queue_segment_bytes, queue_compression,
+            max_lines_per_write, min_lines_per_write, max_bytes_per_write, max_requests_per_second,
+            write_concurrency, max_retries).
+    """
+    config = parse_remote_args(influxdb3_local, args)
+    if config is None:
         return
 
-    max_retries = 3
-    successful_entries = []
-    for attempt in range(max_retries):
-        try:
-            # Write line protocol strings directly
-            lines = [entry["line"] for entry in queued_entries]
-            client.write(lines)  # Write as line protocol
-            successful_entries = queued_entries
-            influxdb3_local.info(f"Replicated {len(successful_entries)} lines to remote instance")
-
-            if do_validate:
-                influxdb3_local.info("Starting validation of replicated entries")
-                for entry in successful_entries:
-                    expected_checksum = entry.get("checksum")
-                    if expected_checksum:
-                        # Convert the integer timestamp (nanoseconds) to RFC3339 format
-                        timestamp_ns = int(entry["line"].split()[-1])  # Extract timestamp from line protocol
-                        # Convert nanoseconds to seconds and microseconds
-                        timestamp_sec = timestamp_ns // 1_000_000_000
-                        timestamp_ns_remainder = timestamp_ns % 1_000_000_000
-                        # Format as RFC3339 (e.g., '2025-03-31T07:43:45.123456789Z')
-                        timestamp_rfc3339 = time.strftime(
-                            "%Y-%m-%dT%H:%M:%S", time.gmtime(timestamp_sec)
-                        ) + f".{timestamp_ns_remainder:09d}Z"
-                        # Use the formatted timestamp in the query
-                        query = f"SELECT * FROM {entry['table']} WHERE time = '{timestamp_rfc3339}' LIMIT 1"
-                        result = client.query(query, language="sql")
-                        # result is a pyarrow.Table, so directly convert to Pandas
-                        actual_line = result.to_pandas().to_csv(index=False)
-                        actual_checksum = hashlib.md5(actual_line.encode()).hexdigest()
-                        if actual_checksum != expected_checksum:
-                            influxdb3_local.error(f"Validation failed for {entry['table']} at {timestamp_rfc3339}")
-
-            truncate_queue(successful_entries)
-            influxdb3_local.cache.put(STATE_KEY, latest_timestamp)
-            break
-        except InfluxDBError as e:
-            if e.response and e.response.status == 429:
-                # Handle 429 Too Many Requests
-                retry_after = int(e.response.headers.get("retry-after", 2 ** attempt))
-                influxdb3_local.info(f"Rate limit hit (429), retrying after {retry_after} seconds")
-                time.sleep(retry_after)
-            else:
-                influxdb3_local.error(f"Replication attempt {attempt + 1} failed: {str(e)}")
-                if attempt < max_retries - 1:
-                    time.sleep(2 ** attempt)
-                else:
-                    influxdb3_local.error("Max retries reached; data remains in queue")
-                    break
-        except Exception as e:
-            influxdb3_local.error(f"Replication attempt {attempt + 1} failed: {str(e)}")
-            if attempt < max_retries - 1:
-                time.sleep(2 ** attempt)
-            else:
-                influxdb3_local.error("Max retries reached; data remains in queue")
-                break
+    def drain(destination):
+        stats = new_drain_stats()
+        drain_with_backoff(influxdb3_local, config, destination, max_retries=config["max_retries"], blocking=True,
+                           stats=stats)
+        return stats
+
+    queue = open_queue(config)
+    for destination, stats in zip(config["destinations"], for_each_destination(config, drain)):
+        if config["self_metrics"]:
+            write_replicator_stats(influxdb3_local, queue, "schedule", stats, destination=destination["name"])